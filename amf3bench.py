@@ -0,0 +1,386 @@
+#!/usr/bin/python
+# Decode throughput benchmarks for amf3reader
+# Runs the reader over the .flm files in flm/ and over synthetic AMF3 streams
+# that each stress one part of the decoder, reporting MB/s, records/s and
+# peak memory. Results can be saved as JSON and checked against a baseline.
+
+# Copyright 2013 Adobe Systems Incorporated.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0.html
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import os
+import time
+import json
+import glob
+import struct
+import resource
+import subprocess
+from cStringIO import StringIO
+from fnmatch import fnmatchcase
+from optparse import OptionParser
+import amf3reader
+
+kCorpusFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "flm")
+kRecords = 20000    # records in each synthetic stream at --scale 1
+kMinBytes = 2000000 # small files are decoded several times per run, to time at least this much
+kManyNames = 17000  # names in the many-names stream, past the 16384 of a two byte reference
+kCheckFilter = ['.rend.*', '.swf.frame', '*7'] # names kept by --check and the filtered mode
+kModes = ['read', 'feed', 'filtered']
+
+class amf3writer:
+    """
+    Just enough of an AMF3 encoder to build test streams
+    Values are written in stream order, as strings and traits are sent
+    by reference once they have been seen
+    """
+    def __init__(self):
+        self.parts = []
+        self.strings = {}
+        self.traits = {}
+
+    def getData(self):
+        return ''.join(self.parts)
+
+    def u29(self, n):
+        if n < 0x80:
+            return chr(n)
+        if n < 0x4000:
+            return chr((n >> 7) | 0x80) + chr(n & 0x7F)
+        if n < 0x200000:
+            return chr((n >> 14) | 0x80) + chr(((n >> 7) & 0x7F) | 0x80) + chr(n & 0x7F)
+        return (chr((n >> 22) | 0x80) + chr(((n >> 15) & 0x7F) | 0x80) +
+                chr(((n >> 8) & 0x7F) | 0x80) + chr(n & 0xFF))
+
+    def writeString(self, s):
+        """ a string without its marker, as used for names and keys """
+        if s in self.strings:
+            self.parts.append(self.u29(self.strings[s] << 1))
+            return
+        if s:
+            self.strings[s] = len(self.strings)
+        self.parts.append(self.u29((len(s) << 1) | 1) + s)
+
+    def writeInteger(self, n):
+        self.parts.append('\x04' + self.u29(n))
+
+    def writeDouble(self, d):
+        self.parts.append('\x05' + struct.pack('>d', d))
+
+    def writeStringValue(self, s):
+        self.parts.append('\x06')
+        self.writeString(s)
+
+    def writeObjectHeader(self, slots, className=""):
+        """ starts an object with sealed traits, its slot values are written next """
+        self.parts.append('\x0a')
+        key = (className, tuple(slots))
+        if key in self.traits:
+            self.parts.append(self.u29((self.traits[key] << 2) | 1))
+            return
+        self.traits[key] = len(self.traits)
+        self.parts.append(self.u29((len(slots) << 4) | 3))
+        self.writeString(className)
+        for slot in slots:
+            self.writeString(slot)
+
+    def writeDictionaryHeader(self, count):
+        """ starts a Dictionary, the count keys and values are written next """
+        self.parts.append('\x11' + self.u29((count << 1) | 1) + '\x00')
+
+    def writeVector(self, marker, code, values):
+        self.parts.append(marker + self.u29((len(values) << 1) | 1) + '\x00' +
+            struct.pack('>%d%s' % (len(values), code), *values))
+
+    def writeRecord(self, name, slots):
+        """ starts a top level telemetry record, the values of slots are written next """
+        self.writeObjectHeader(['name'] + slots)
+        self.writeStringValue(name)
+
+def makeTraitsReuse(count):
+    """ small records reusing a few traits, with objects nested four deep """
+    writer = amf3writer()
+    names = ['.rend.screen', '.as.event', '.swf.frame', '.network.read']
+    for i in xrange(count):
+        writer.writeRecord(names[i & 3], ['span', 'delta', 'value'])
+        writer.writeInteger(i & 0x3FF)
+        writer.writeInteger(7)
+        for depth in range(3):
+            writer.writeObjectHeader(['depth', 'child'])
+            writer.writeInteger(depth)
+        writer.writeObjectHeader(['x', 'y'])
+        writer.writeInteger(i & 0xFF)
+        writer.writeDouble(i * 0.5)
+    return writer.getData()
+
+def makeLongStrings(count):
+    """ records each carrying a new 1-8KB string """
+    writer = amf3writer()
+    for i in xrange(count / 8):
+        writer.writeRecord('.tlm.text', ['value'])
+        writer.writeStringValue(('%08d' % i) * (128 * (1 + (i & 7))))
+    return writer.getData()
+
+def makeTypedVectors(count):
+    """ records holding a Vector.<int> and a Vector.<Number> of 256 entries """
+    writer = amf3writer()
+    ints = range(256)
+    doubles = [n * 0.25 for n in ints]
+    for i in xrange(count / 4):
+        writer.writeRecord('.gpu.vectors', ['ints', 'doubles'])
+        writer.writeVector('\x0d', 'I', ints)
+        writer.writeVector('\x0f', 'd', doubles)
+    return writer.getData()
+
+def makeDictionaries(count):
+    """ records holding a Dictionary of 32 integer keys to strings """
+    writer = amf3writer()
+    for i in xrange(count / 4):
+        writer.writeRecord('.tlm.dictionary', ['value'])
+        writer.writeDictionaryHeader(32)
+        for key in range(32):
+            writer.writeInteger(key)
+            writer.writeStringValue('item%d' % key)
+    return writer.getData()
+
+def makeFlash11(count):
+    """ old style records: a name then a value, spans as .span/.time pairs """
+    writer = amf3writer()
+    names = ['.rend.screen', '.as.event', '.network.read']
+    for i in xrange(count):
+        if i & 1:
+            name = names[i % 3]
+            writer.writeString(name + '.span')
+            writer.writeInteger(i & 0x3FF)
+            writer.writeString(name + '.time')
+            writer.writeDouble(i * 10.0)
+        else:
+            writer.writeString('.mem.used.count')
+            writer.writeInteger(i)
+    return writer.getData()
+
+def makeManyNames(count):
+    """
+    more distinct record names than a two byte string reference holds, each
+    written once and then referred to again in a scattered order
+    """
+    writer = amf3writer()
+    names = ['.tlm.name%d' % i for i in xrange(kManyNames)]
+    for i in xrange(kManyNames + count):
+        name = names[i] if i < kManyNames else names[(i * 7919) % kManyNames]
+        writer.writeRecord(name, ['value'])
+        writer.writeInteger(i & 0x3FF)
+    return writer.getData()
+
+kSynthetic = [
+    ('traits-reuse', makeTraitsReuse),
+    ('long-strings', makeLongStrings),
+    ('typed-vectors', makeTypedVectors),
+    ('dictionaries', makeDictionaries),
+    ('flash11', makeFlash11),
+    ('many-names', makeManyNames),
+]
+
+def getScenarios():
+    """ names of all scenarios, the corpus files first """
+    names = []
+    for path in sorted(glob.glob(os.path.join(kCorpusFolder, "*.flm"))):
+        names.append("corpus:" + os.path.splitext(os.path.basename(path))[0])
+    names += ["synthetic:" + name for name, make in kSynthetic]
+    return names
+
+def getData(scenario, scale):
+    kind, name = scenario.split(":", 1)
+    if kind == "corpus":
+        return open(os.path.join(kCorpusFolder, name + ".flm"), 'rb').read()
+    return dict(kSynthetic)[name](int(kRecords * scale))
+
+def getMetrics(reader, data, mode):
+    """
+    decodes data the way mode says: read it whole, feed it in chunks through
+    iter_metrics, or read it whole keeping only the kCheckFilter names
+    """
+    if mode == 'feed':
+        return amf3reader.iter_metrics(StringIO(data), reader=reader)
+    if mode == 'filtered':
+        reader.nameFilter = amf3reader.makeNameFilter(kCheckFilter)
+    reader.setData(data)
+    return reader.readMetrics()
+
+def runScenario(scenario, repeat, scale, mode):
+    """ decodes one scenario repeat times, returns the best run """
+    data = getData(scenario, scale)
+    loops = max(1, kMinBytes / max(len(data), 1))
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        records = 0
+        for loop in xrange(loops):
+            reader = amf3reader.amf3reader()
+            for metric in getMetrics(reader, data, mode):
+                records += 1
+            del reader
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    best = max(best, 1e-9)
+    return {
+        'scenario': scenario,
+        'mode': mode,
+        'bytes': len(data),
+        'records': records / loops,
+        'seconds': best / loops,
+        'mb_per_s': len(data) * loops / best / 1e6,
+        'records_per_s': records / best,
+        # ru_maxrss is in KB on Linux and in bytes on Mac
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+            (1024 if sys.platform == 'darwin' else 1),
+    }
+
+def getValues(record):
+    """ the fields of a record to compare, a filtered decode passes on the delta of skipped records """
+    if not hasattr(record, 'keys'):
+        return record
+    values = record.asDict() if hasattr(record, 'asDict') else dict(record)
+    values.pop('delta', None)
+    return values
+
+def isKept(record):
+    """ whether a name filter of kCheckFilter lets a record through, values without a name always pass """
+    if not hasattr(record, 'keys') or 'name' not in record:
+        return True
+    return any(fnmatchcase(record['name'], pattern) for pattern in kCheckFilter)
+
+def checkScenario(scenario, scale):
+    """ returns an error if decoding with a name filter does not keep the same records as a full decode """
+    data = getData(scenario, scale)
+    reader = amf3reader.amf3reader()
+    reader.setData(data)
+    expected = [getValues(record) for record in reader.readMetrics() if isKept(record)]
+    reader = amf3reader.amf3reader()
+    reader.nameFilter = amf3reader.makeNameFilter(kCheckFilter)
+    reader.setData(data)
+    filtered = [getValues(record) for record in reader.readMetrics()]
+    if filtered == expected:
+        return None
+    for index, (record, want) in enumerate(zip(filtered, expected)):
+        if record != want:
+            return "%s: filtered record %d is %r, expected %r" % (scenario, index, record, want)
+    return "%s: filtered decode kept %d records, expected %d" % (scenario, len(filtered), len(expected))
+
+def runChild(scenario, repeat, scale, mode):
+    """ runs a scenario in its own process, so peak memory is its own """
+    command = [sys.executable, os.path.abspath(__file__), "--child", scenario,
+               "--repeat", str(repeat), "--scale", str(scale), "--mode", mode]
+    output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0]
+    return json.loads(output)
+
+def compare(results, baseline, tolerance):
+    """ returns a line for each scenario that got slower or bigger than the baseline allows """
+    # results saved before there were modes are read mode ones
+    getKey = lambda result: (result['scenario'], result.get('mode', 'read'))
+    previous = dict((getKey(result), result) for result in baseline['results'])
+    regressions = []
+    for result in results:
+        base = previous.get(getKey(result))
+        if not base:
+            continue
+        name = "%s (%s)" % getKey(result)
+        if result['records_per_s'] < base['records_per_s'] * (1 - tolerance):
+            regressions.append("%s: %.0f records/s, baseline %.0f" %
+                (name, result['records_per_s'], base['records_per_s']))
+        if result['peak_rss_kb'] > base['peak_rss_kb'] * (1 + tolerance):
+            regressions.append("%s: peak RSS %d KB, baseline %d KB" %
+                (name, result['peak_rss_kb'], base['peak_rss_kb']))
+    return regressions
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-s", "--scenario",
+        action="append", dest="scenarios", default=[], metavar="PATTERN",
+        help="only run scenarios matching PATTERN, e.g. 'synthetic:*' (may repeat)")
+    parser.add_option("-l", "--list",
+        action="store_true", dest="list", default=False,
+        help="list the scenarios")
+    parser.add_option("-r", "--repeat",
+        action="store", type="int", dest="repeat", default=3,
+        help="decode each scenario # times and keep the best")
+    parser.add_option("", "--scale",
+        action="store", type="float", dest="scale", default=1.0,
+        help="multiply the size of the synthetic streams")
+    parser.add_option("-o", "--output",
+        action="store", dest="output", default=None, metavar="FILE",
+        help="save the results as JSON")
+    parser.add_option("-b", "--baseline",
+        action="store", dest="baseline", default=None, metavar="FILE",
+        help="fail if a scenario regresses past the results saved in FILE")
+    parser.add_option("-t", "--tolerance",
+        action="store", type="float", dest="tolerance", default=0.2,
+        help="fraction a scenario may regress before failing (default 0.2)")
+    parser.add_option("-m", "--mode",
+        action="append", dest="modes", default=[], choices=kModes,
+        help="how to decode: read (default) whole, feed in chunks through iter_metrics, "
+             "or filtered by name (may repeat)")
+    parser.add_option("-c", "--check",
+        action="store_true", dest="check", default=False,
+        help="check a decode with a name filter keeps the same records as a full one, instead of timing")
+    parser.add_option("", "--child",
+        action="store", dest="child", default=None,
+        help="used internally to run one scenario")
+    (options, args) = parser.parse_args()
+
+    if options.child:
+        print json.dumps(runScenario(options.child, options.repeat, options.scale, options.modes[0]))
+        sys.exit(0)
+
+    scenarios = getScenarios()
+    if options.scenarios:
+        scenarios = [name for name in scenarios
+                     if any(fnmatchcase(name, pattern) for pattern in options.scenarios)]
+    if options.list:
+        for name in scenarios:
+            print name
+        sys.exit(0)
+
+    if options.check:
+        errors = []
+        for scenario in scenarios:
+            error = checkScenario(scenario, options.scale)
+            print "%-24s %s" % (scenario, "FAILED" if error else "ok")
+            if error:
+                errors.append(error)
+        for error in errors:
+            print error
+        sys.exit(1 if errors else 0)
+
+    results = []
+    print "%-24s %-8s %10s %10s %12s %10s" % ("scenario", "mode", "KB", "MB/s", "records/s", "RSS KB")
+    for scenario in scenarios:
+        for mode in options.modes or ['read']:
+            result = runChild(scenario, options.repeat, options.scale, mode)
+            results.append(result)
+            print "%-24s %-8s %10d %10.2f %12.0f %10d" % (scenario, mode, result['bytes'] / 1024,
+                result['mb_per_s'], result['records_per_s'], result['peak_rss_kb'])
+
+    if options.output:
+        output = open(options.output, 'w')
+        json.dump({'python': sys.version.split()[0], 'scale': options.scale,
+                   'repeat': options.repeat, 'results': results}, output, indent=1)
+        output.close()
+
+    if options.baseline:
+        regressions = compare(results, json.load(open(options.baseline)), options.tolerance)
+        for line in regressions:
+            print "REGRESSION", line
+        if regressions:
+            sys.exit(1)
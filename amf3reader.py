@@ -17,14 +17,247 @@
 # limitations under the License.
 
 
-from struct import unpack
+from struct import Struct, unpack_from
 from datetime import datetime
+from functools import partial
+from fnmatch import fnmatchcase
+from timeit import default_timer
+from array import array
+from math import isinf, isnan
+import sys
+import os
+import re
+import keyword
+import mmap
+import marshal
+import bisect
+
+# precompiled big-endian readers, used with unpack_from at an offset
+# so primitive reads never slice a copy out of the buffer
+kUint16 = Struct('>H')
+kUint32 = Struct('>I')
+kDouble = Struct('>d')
+
+# object marker, traits reference, string marker, string reference (up to two
+# bytes): the header of most records, as their traits and name are references
+kRecordHeader = Struct('>BBBBB')
+
+# typed vectors can be returned as array.array, which holds native byte order
+kLittleEndian = sys.byteorder == 'little'
+kUint32Array = 'I' if array('I').itemsize == 4 else 'L'
+
+# default read size for iter_metrics
+kChunkSize = 64*1024
+
+# consumed bytes are only discarded once at least this much has been read
+# (and at least half of the buffer), which keeps compaction amortized linear
+kCompactThreshold = 64*1024
 
 class Metric:
     pass
 
+class amf3record(object):
+    """
+    Base for the compact record classes made for each traits shape.
+    Values are held in __slots__ but read like a dict, asDict gives a real one.
+    A slot never set (the 'id' of a nested object) reads as a missing key
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if key in self.__slots__:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        if key in self.__slots__:
+            return getattr(self, key, default)
+        return default
+
+    def has_key(self, key):
+        return key in self.__slots__ and hasattr(self, key)
+
+    __contains__ = has_key
+
+    def keys(self):
+        return [key for key in self.__slots__ if hasattr(self, key)]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def asDict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, amf3record):
+            other = other.asDict()
+        return self.asDict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.asDict())
+
+class SymbolTable(object):
+    """
+    Maps metric names to small integer ids, in order of first use
+    Ids are the same for every reader in the process, so analysis code can
+    dispatch and aggregate on integers instead of comparing strings
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def intern(self, name):
+        """ returns the id for name, adding it if new """
+        nameId = self.ids.get(name)
+        if nameId is None:
+            if type(name) == str:
+                name = intern(name)
+            nameId = len(self.names)
+            self.names.append(name)
+            self.ids[name] = nameId
+        return nameId
+
+    def getName(self, nameId):
+        return self.names[nameId]
+
+    def __len__(self):
+        return len(self.names)
+
+# metric name ids shared across readers and the analysis layer
+symbols = SymbolTable()
+
+def evenBytes(first, last):
+    return '[' + ''.join(re.escape(chr(c)) for c in range(first, last + 1, 2)) + ']'
+
+# a scalar value or a string reference, which can be skipped without
+# touching the reference tables: undefined, null, false, true, an integer,
+# a double, or a string by reference (the uint29 is even) or empty
+# (references past the first 2M strings are left to skipValue)
+kScalarPattern = ('(?:[\x00-\x03]'
+    '|\x04(?:[\x80-\xff]{0,2}[\x00-\x7f]|[\x80-\xff]{3}[\x00-\xff])'
+    '|\x05[\x00-\xff]{8}'
+    '|\x06(?:\x01|[\x80-\xff]{0,2}%s))' % evenBytes(0, 0x7e))
+
+scalarRuns = {} # compiled pattern matching exactly count scalars, by count
+deltaRuns = {}  # scalars around an integer of up to two bytes, by counts
+
+def getScalarRun(count):
+    scalarRun = scalarRuns.get(count)
+    if scalarRun is None:
+        scalarRun = scalarRuns[count] = re.compile('%s{%d}' % (kScalarPattern, count))
+    return scalarRun
+
+def getSkipRun(traits):
+    """
+    pattern for the slots after the name when they are scalars, with a small
+    integer delta in group 1. None for dynamic traits, which it can't cover
+    """
+    if traits['dynamic']:
+        return None
+    slots = traits['slots']
+    count = len(slots) - 1
+    if 'delta' in slots:
+        before = slots.index('delta') - 1
+        return getDeltaRun(before, count - before - 1)
+    return getScalarRun(count)
+
+def getDeltaRun(before, after):
+    deltaRun = deltaRuns.get((before, after))
+    if deltaRun is None:
+        deltaRun = deltaRuns[(before, after)] = re.compile(
+            '%s{%d}\\x04([\\x00-\\x7f]|[\\x80-\\xff][\\x00-\\x7f])%s{%d}'
+            % (kScalarPattern, before, kScalarPattern, after))
+    return deltaRun
+
+recordRuns = {} # run of records by the slot counts of the traits seen so far
+
+def getRecordRun(traitsList):
+    """
+    pattern for a run of whole records made of scalars, each an object with a
+    reference to one of the sealed traits in traitsList. As the slot count of
+    each traits is fixed, every match ends on a record boundary. None if
+    there are no sealed traits yet
+    """
+    shapes = tuple(-1 if traits['dynamic'] else len(traits['slots']) for traits in traitsList)
+    recordRun = recordRuns.get(shapes, False)
+    if recordRun is False:
+        records = []
+        for index, count in enumerate(shapes):
+            if count >= 0:
+                ref = (index << 2) | 1
+                header = chr(ref) if ref < 0x80 else chr((ref >> 7) | 0x80) + chr(ref & 0x7F)
+                records.append('%s%s{%d}' % (re.escape(header), kScalarPattern, count))
+        recordRun = None
+        if records:
+            recordRun = re.compile('(?:\\x0a(?:%s))+' % '|'.join(records))
+        recordRuns[shapes] = recordRun
+    return recordRun
+
+# kinds of old style (flash11) record, by the suffix of the name
+kOldStyleValue, kOldStyleSpan, kOldStyleTime = range(3)
+kOldStyleSuffixes = [('.span', kOldStyleSpan), ('.time', kOldStyleTime), ('.count', kOldStyleValue)]
+kOldStyleFields = [('name', 'value'), ('name', 'span', 'time'), ('name', 'time')]
+
+def rejectAll(name):
+    return False
+
+# returned by amf3reader.readRecord for a record rejected by its nameFilter
+kSkipped = Metric()
+
+def makeNameFilter(patterns):
+    """
+    returns a nameFilter accepting names that match any of the glob patterns,
+    e.g. ['.rend.*', '.swf.frame']. Each name is only matched once.
+    """
+    patterns = list(patterns)
+    matches = {}
+    def nameFilter(name):
+        match = matches.get(name)
+        if match is None:
+            match = matches[name] = any(fnmatchcase(str(name), pattern) for pattern in patterns)
+        return match
+    return nameFilter
+
+# one record class per (className, slots), shared by all readers
+recordClasses = {}
+
+def getRecordClass(className, slots):
+    """ returns the record class for a traits shape, or None if its slots can't be attributes """
+    key = (className, tuple(slots))
+    if key in recordClasses:
+        return recordClasses[key]
+    recordClass = None
+    valid = len(set(slots)) == len(slots)
+    for slot in slots:
+        if (not re.match(r'[A-Za-z_][A-Za-z0-9_]*$', slot) or keyword.iskeyword(slot)
+            or slot.startswith('__') or hasattr(amf3record, slot)):
+            valid = False
+    if valid:
+        name = re.sub(r'\W', '_', className).strip('_') or 'record'
+        recordClass = type(name, (amf3record,), {'__slots__':tuple(slots)})
+    recordClasses[key] = recordClass
+    return recordClass
+
 def ByteToHex( byteStr ):
-    return ' '.join( [ "%02X" % ord( x ) for x in byteStr ] )
+    return ' '.join( [ "%02X" % x for x in bytearray(byteStr) ] )
 
 class amf3reader(dict):
     """
@@ -36,9 +269,30 @@ class amf3reader(dict):
     if called on its own this file will convert amf content to python
     """
 
-    # Set verbose to True to get a detailed report on AMF3 encoding with hex
+    # True for amf3tracer, which prints a detailed report on AMF3 encoding with hex
     verbose = False
 
+    # Set vectorsAsArrays to True to get Vector.<int>/<uint>/<Number> as compact
+    # array.array objects rather than lists
+    vectorsAsArrays = False
+
+    # Set compactRecords to True to get objects with fixed traits as amf3record
+    # instances (one __slots__ class per traits shape) rather than dicts
+    compactRecords = False
+
+    # Set nameIds to True to add the symbols id of the name to each metric as 'id'
+    # Only top level records with a string name get one, not nested objects
+    nameIds = False
+
+    # Set scanFirst to True to have feed() check each record is whole with
+    # scanRecord before decoding it, so no record is ever decoded in part
+    # (for subclasses that trace or count what they decode)
+    scanFirst = False
+
+    # Set nameFilter to a function of the metric name (see makeNameFilter) to
+    # skip the bodies of records it rejects without decoding them
+    nameFilter = None
+
     kUndefinedAtomType      = 0
     kNullAtomType           = 1
     kFalseAtomType          = 2
@@ -60,23 +314,55 @@ class amf3reader(dict):
 
     def __init__(self, newData = None):
         # Lock on to the file
-        self.data = ""
+        # data is held in a bytearray so addData can append in place
+        # and committed records can be compacted away from the front
+        self.data = bytearray()
         if newData:
-            self.data = newData
+            self.data = bytearray(newData)
         self.pos = 0        
+        self.base = 0       # stream offset of self.data[0] (bytes compacted away)
         self.stringList = []
         self.traitsList = []
+        self.traitsDecoders = []   # compiled decoder for each entry in traitsList
+        self.skipRuns = {}  # getSkipRun pattern by traits index, made as records are skipped
         self.objectsList = []
         self.format = None
         self.flash11Mode = False  
+        self.oldStyleNames = {} # (kind, name, id) by old style record name
+        self.scanStack = None   # scanRecord state for a partially received record
+        self.skippedDelta = 0   # delta time of skipped records not yet passed on
+        self.decoders = self.makeDecoders()
         
     def setData(self, data):
-        self.data = data;
+        self.startData(bytearray(data))
+
+    def startData(self, data):
+        """ starts reading a new stream from the start of data """
+        self.data = data
+        self.pos = 0
+        self.base = 0
+        self.format = None
+        self.flash11Mode = False
+        self.scanStack = None
+        self.skippedDelta = 0
         self.getFormat()
 
     def addData(self, data):
-        self.data += data;
-        self.getFormat()
+        self.data.extend(data);
+        if self.format is None:
+            self.getFormat()
+
+    def tell(self):
+        """ offset of the read position from the start of the stream """
+        return self.base + self.pos
+
+    def compact(self):
+        """ discards consumed bytes, only call between records """
+        pos = self.pos
+        if pos >= kCompactThreshold and pos*2 >= len(self.data):
+            del self.data[:pos]
+            self.base += pos
+            self.pos = 0
                         
     def addString(self, string):
         index = len(self.stringList)
@@ -105,360 +391,317 @@ class amf3reader(dict):
             print("invalid string reference " + str(index))
         return string
         
-    def printHex(self,count):
-         if self.verbose and self.pos+count <= len(self.data):
-             print ByteToHex(self.data[self.pos:self.pos+count]), 
-        
     def peekByte(self):
         if (self.pos < len(self.data)):
-            return ord(self.data[self.pos])
+            return self.data[self.pos]
         else:
             return None
             
     def readByte(self):
-        val = None
-        if self.pos+1 <= len(self.data):
-            val = self.data[self.pos]
-            self.printHex(1)
-            self.pos += 1
-            return ord(val)
-        else:
-            raise EOFError;
-        return val
+        pos = self.pos
+        if pos < len(self.data):
+            self.pos = pos + 1
+            return self.data[pos]
+        raise EOFError
     
     def readInt(self):
-        val = None
-        if self.pos+4 <= len(self.data):
-            val = unpack('>I', self.data[self.pos:self.pos+4])[0]
-            self.pos += 4
-        else:
-            raise EOFError;
-        return val
-                
+        pos = self.pos
+        if pos+4 <= len(self.data):
+            self.pos = pos + 4
+            return kUint32.unpack_from(self.data, pos)[0]
+        raise EOFError
 
     def readShort(self):
-        val = None
-        if self.pos+2 <= len(self.data):
-            val =  unpack('>H', self.data[self.pos:self.pos+2])[0]
-            self.pos += 2;
-        else:
-            raise EOFError;
-        return val
-        
+        pos = self.pos
+        if pos+2 <= len(self.data):
+            self.pos = pos + 2
+            return kUint16.unpack_from(self.data, pos)[0]
+        raise EOFError
 
     def readDouble(self):
-        val = None
-        if self.pos+8 <= len(self.data):
-            val = unpack('>d', self.data[self.pos:self.pos+8])[0]
-            self.printHex(8)
-            self.pos += 8
-        else:
-            raise EOFError;
-        return val
-
+        pos = self.pos
+        if pos+8 <= len(self.data):
+            self.pos = pos + 8
+            return kDouble.unpack_from(self.data, pos)[0]
+        raise EOFError
 
     def readBytes(self,length):
-        val = None
-        if (self.verbose): print "bytes: ",
-		
-        if self.pos+length <= len(self.data):
-            val = self.data[self.pos:self.pos+length]
-            self.printHex(length)
-            self.pos += length
-        else:
-            raise EOFError;
-            
-        if (self.verbose): print ""; # Move to next line (self.printHex above would have printed all bytes)
-        return val
-
+        pos = self.pos
+        end = pos + length
+        if end <= len(self.data):
+            self.pos = end
+            return str(self.data[pos:end])
+        raise EOFError
 
     def readUint29(self):         
         byte = self.readByte()
-        if byte == None: return None
         if byte < 128:
             return byte;        
         ref = (byte & 0x7F) << 7
         byte = self.readByte()
-        if byte == None: return None
         if byte < 128:
             return (ref | byte)
         ref = (ref | (byte & 0x7F)) << 7
         byte = self.readByte()
-        if byte == None: return None
         if byte < 128:
             return (ref | byte)
         ref = (ref | (byte & 0x7F)) << 8
         byte = self.readByte()
-        if byte == None: return None
         return (ref | byte);
 
 
     def readAmfString(self, stringWithoutMarker, noCache=False):
         """ reads and AMF formatted string tracking references """
-        
-        if (self.verbose and stringWithoutMarker):
-            print "String(wm) ",
-        
         ref = self.readUint29()
-        
-        if ref == None: return None
         if (ref & 1) == 0:
-            if (self.verbose) : print "Ref: %d" %(ref>>1),
             return self.getString(ref >> 1);
         length = ref >> 1;
         if length == 0:
             return ""
-        
-        if (self.verbose) : print " (%d) Len: %d" % (len(self.stringList), (ref>>1)),
         s = self.readBytes(length)
-        
         if not noCache:  # for flash11 support
             self.addString(s)
         return s
 
+    def makeDecoders(self):
+        """ builds the dispatch table mapping each type marker to its handler
+            handlers are looked up by name so subclasses can override them
+        """
+        decoders = [partial(self.decodeInvalid, encoding) for encoding in range(256)]
+        decoders[self.kUndefinedAtomType]     = self.decodeUndefined
+        decoders[self.kNullAtomType]          = self.decodeNull
+        decoders[self.kFalseAtomType]         = self.decodeFalse
+        decoders[self.kTrueAtomType]          = self.decodeTrue
+        decoders[self.kIntegerAtomType]       = self.decodeInteger
+        decoders[self.kDoubleAtomType]        = self.decodeDouble
+        decoders[self.kStringAtomType]        = self.decodeString
+        decoders[self.kAvmMinusXmlAtomType]   = self.decodeXml
+        decoders[self.kDateAtomType]          = self.decodeDate
+        decoders[self.kArrayAtomType]         = self.decodeArray
+        decoders[self.kObjectAtomType]        = self.decodeObject
+        decoders[self.kAvmPlusXmlAtomType]    = self.decodeXml
+        decoders[self.kByteArrayAtomType]     = self.decodeByteArray
+        decoders[self.kTypedVectorIntType]    = self.decodeVectorInt
+        decoders[self.kTypedVectorUintType]   = self.decodeVectorUint
+        decoders[self.kTypedVectorDoubleType] = self.decodeVectorDouble
+        decoders[self.kTypedVectorObjectType] = self.decodeVectorObject
+        decoders[self.kDictionaryObjectType]  = self.decodeDictionary
+        return decoders
+
     def readAmfObject(self) :
-        encoding = self.readByte();
-        if encoding == None:
-            return None
+        return self.decoders[self.readByte()]()
 
-        encoding = encoding & 255;
-        value = None;
-
-        if encoding == self.kIntegerAtomType:
-            value = self.readUint29(); 
-            if (self.verbose) : print "Int29=%d" % value;
-        elif encoding == self.kDoubleAtomType:
-            value = self.readDouble(); 
-            if (self.verbose) : print "Double=%g" % value;
-        elif encoding == self.kStringAtomType:
-            if (self.verbose) : print "String ",
-            value = self.readAmfString(False, self.flash11Mode); # early format support
-            if (self.verbose) : print " \"%s\"" % value;
-        elif encoding == self.kNullAtomType:
-            value = None;
-            if (self.verbose) : print "Null"
-        elif encoding == self.kUndefinedAtomType:
-            value = None;
-            if (self.verbose) : print "Undefined"
-        elif encoding == self.kFalseAtomType:
-            value = False; 
-            if (self.verbose) : print "False"
-        elif encoding == self.kTrueAtomType:
-            value = True; 
-            if (self.verbose) : print "True"
-        elif encoding == self.kDateAtomType:
-            ref = self.readUint29()
-            
-            if (self.verbose) : print "Date ",
-            
-            if (ref & 1) == 0:
-                value = self.getObject(ref>>1);
-                if (self.verbose): print "Ref: " + str(ref>>1);
-            else:
-                if (self.verbose) : print "(%d)" % len(self.objectsList);
-                value = self.readDouble(); # dates are written as doubles
-                if (self.verbose) : print " " + str(value) + " " + datetime.fromtimestamp(value/1000).isoformat();
-                self.addObject(value);
-        elif (encoding == self.kAvmMinusXmlAtomType or
-            encoding == self.kAvmPlusXmlAtomType ):
-            ref = self.readUint29()
-            if (self.verbose) : 
-                print "XML ",
-                if encoding == self.kAvmMinusXmlAtomType :
-                    print "- ",
-                else :
-                    print "+ ",
-            
-            if (ref & 1) == 0:
-                value = self.getObject(ref>>1);
-                if (self.verbose) : print "Ref: " + str(ref>>1);
-            else:
-                if (self.verbose) : print "(%d)" % len(self.objectsList);
-                if (self.verbose) : self.printHex(ref >> 1)
-                value = self.readBytes(ref >> 1); # return as string for now
-                if (self.verbose) : print value.encode()
-                self.addObject(value);
-        elif encoding == self.kDictionaryObjectType:
-            ref = self.readUint29()
-            
-            if (self.verbose) : print "Dictionary ",
-            if (ref & 1) == 0:
-                value = self.getObject(ref>>1);
-                if (self.verbose) : print "Ref: " + str(ref>>1);
-            else:
-                if (self.verbose) : 
-                    print "(%d)" % len(self.objectsList) ,
-                    print " count: %d" %(ref>>1);
-                weakref = self.readByte() == 1
-                if (self.verbose) : print "weakRef";
-                count = ref >> 1
-                value = {}
-                self.addObject(value);
-                while count > 0:
-                    key = self.readAmfObject()
-                    val = self.readAmfObject()
-                    #print key
-                    #print val
-                    value[str(key)] = val
-                    count -= 1
-                if (self.verbose) : print '\n',
-        elif encoding == self.kArrayAtomType:
-            value = {}
-            ref = self.readUint29()
-            if (self.verbose) : print "Array ",
-            
-            if (ref & 1) == 0 :
-                value = self.getObject(ref>>1);
-                if (self.verbose) : print "Ref: " + str(ref);
-            else :
-                if (self.verbose) : 
-                    print "(%d)" % len(self.objectsList)
-                    print "count: %d" % (ref>>1);
-                self.addObject(value);
-                count = ref >> 1
-                # read the non-dense portion
-                s = self.readAmfString(True)
-                while  s and len(s)>0:
-                    if (self.verbose) : print "%s (dyn)" % (s)
-                    v = self.readAmfObject()
-                    value[s] = v
-                    s = self.readAmfString(True)
-                    if (self.verbose) : print ""
-                 #now read the dense portion
-                i = 0
-                while i < count:
-                    if (self.verbose) : print "[%d]" % i
-                    value[i] = self.readAmfObject();
-                    i += 1
-                if (self.verbose) : print '\n',
-        elif ( encoding == self.kTypedVectorIntType or
-            encoding == self.kTypedVectorUintType or
-            encoding == self.kTypedVectorDoubleType or
-            encoding == self.kTypedVectorObjectType ):
-            ref = self.readUint29()
-            
-            if (self.verbose) : 
-                if (encoding == self.kTypedVectorIntType):
-                    print "Vector Int",
-                elif (encoding == self.kTypedVectorUintType) :
-                    print "Vector Uint",
-                elif (encoding == self.kTypedVectorDoubleType) :
-                    print "Vector Double",
-                else:
-                    print "Vector Object",
-            
-            if (ref & 1) == 0:
-                value = self.getObject(ref>>1);
-                print " Ref: " + str(ref>>1);
-            else:
-                count = ref >> 1
-                if (self.verbose): print "length = %d" % count
-                fixed = self.readByte() == 1
-                if (self.verbose) : print "fixed"
-                value = []
-                self.addObject(value);
-                if (encoding == self.kTypedVectorIntType or encoding == self.kTypedVectorUintType):
-                    while(count > 0):
-                        self.printHex(4)
-                        value.append(self.readInt())
-                        count -= 1
-                        if (self.verbose) : print " "
-                    if (self.verbose): print value
-                elif encoding == self.kTypedVectorDoubleType:
-                    while(count > 0):
-                        value.append(self.readDouble())
-                        count -= 1
-                elif encoding == self.kTypedVectorObjectType:
-                    className = self.readAmfString(True);
-                    if (self.verbose): print "ClassName = %s" % className
-                    while (count > 0):
-                        value.append(self.readAmfObject());
-                        count -= 1
-                if (self.verbose) : print '\n',
-        elif encoding == self.kByteArrayAtomType:
-            ref = self.readUint29();
-            
-            if (self.verbose):
-                print "ByteArray ",
-            
-            if (ref & 1) == 0:
-                value = self.getObject(ref>>1);
-                if (self.verbose) : print "Ref: " + str(ref>>1)
-            else:
-                if (self.verbose) : print "count: " + str(ref>>1);
-                value = self.readBytes(ref>>1);
-                self.addObject(value);
-        elif encoding == self.kObjectAtomType:
-            ref = self.readUint29()
-            #if ref == None: return None
-            if (self.verbose):
-                print "Object ",
-            if (ref & 1) == 0: 
-                value = self.getObject(ref>>1);
-                if (self.verbose) : print "Ref: " + str(ref>>1);
-            else :
-                if (self.verbose) : print "(%d)" % len(self.objectsList),
-                if ((ref & 3) == 1):
-                    if (self.verbose) : print "Traits Ref: " + str(ref>>2) + " (class: %s slots: %d dynamic: %d)" %(self.traitsList[ref>>2]['className'], len(self.traitsList[ref>>2]['slots']), self.traitsList[ref>>2]['dynamic']);
-                    traits = self.traitsList[ref >> 2];
-                else:
-                    traits = {}
-                    traits['dynamic'] = ((ref & 8) >> 3);
+    def decodeInvalid(self, encoding):
+        print("invalid data type", encoding);
+        #throw new Error("invalid data stream");
+        return None
 
-                    if ref & 4:
-                        traits['externalizable'] = True
-                        
-                    traits['count'] = ref >> 4
-                    
-                    if self.verbose: 
-                         print "Traits (%d) slots: %d dynamic: %d" % (len(self.traitsList), (ref>>4), ((ref & 8) >> 3))
-                    
-                    className = self.readAmfString(True)
-                    
-                    if self.verbose:
-                        print "class: " + className
-                    
-                    if className and len(className) > 0:
-                        traits['className'] = className
-                    else : 
-                        traits['className'] = ""
-                    #new_class = type(className', (object,), {));
-                    slots = [];
-                    count = traits['count']
-                    while (count):
-                        slots.append(self.readAmfString(True))
-                        if self.verbose: print slots[len(slots)-1]
-                        count -= 1
-                    traits['slots'] = slots
-                    self.traitsList.append(traits)
-                value = {}
-                
-                self.addObject(value);
-                
-                #if  traits.has_key('className'):
-                #    value['_className'] = traits['className']
-                for slot in traits['slots']:
-                    value[slot] = self.readAmfObject()
-                    
-                if (traits['dynamic'] == 1):
-                    s = self.readAmfString(True)
-                    while  s and len(s)>0:
-                        if (self.verbose) : print "%s (dyn)" % (s)
-                        v = self.readAmfObject()
-                        value[s] = v
-                        s = self.readAmfString(True)
-                if (self.verbose) : print '\n',
+    def decodeUndefined(self):
+        return None
+
+    def decodeNull(self):
+        return None
+
+    def decodeFalse(self):
+        return False
+
+    def decodeTrue(self):
+        return True
+
+    def decodeInteger(self):
+        return self.readUint29()
+
+    def decodeDouble(self):
+        return self.readDouble()
+
+    def decodeString(self):
+        return self.readAmfString(False, self.flash11Mode); # early format support
+
+    def decodeDate(self):
+        ref = self.readUint29()
+        if (ref & 1) == 0:
+            return self.getObject(ref>>1);
+        value = self.readDouble(); # dates are written as doubles
+        self.addObject(value);
+        return value
+
+    def decodeXml(self):
+        ref = self.readUint29()
+        if (ref & 1) == 0:
+            return self.getObject(ref>>1);
+        value = self.readBytes(ref >> 1); # return as string for now
+        self.addObject(value);
+        return value
+
+    def decodeByteArray(self):
+        ref = self.readUint29();
+        if (ref & 1) == 0:
+            return self.getObject(ref>>1);
+        value = self.readBytes(ref>>1);
+        self.addObject(value);
+        return value
+
+    def decodeDictionary(self):
+        ref = self.readUint29()
+        if (ref & 1) == 0:
+            return self.getObject(ref>>1);
+        weakref = self.readByte() == 1
+        count = ref >> 1
+        value = {}
+        self.addObject(value);
+        readAmfObject = self.readAmfObject
+        while count > 0:
+            key = readAmfObject()
+            value[str(key)] = readAmfObject()
+            count -= 1
+        return value
+
+    def decodeArray(self):
+        ref = self.readUint29()
+        if (ref & 1) == 0 :
+            return self.getObject(ref>>1);
+        value = {}
+        self.addObject(value);
+        count = ref >> 1
+        # read the non-dense portion
+        s = self.readAmfString(True)
+        while s:
+            value[s] = self.readAmfObject()
+            s = self.readAmfString(True)
+        #now read the dense portion
+        for i in xrange(count):
+            value[i] = self.readAmfObject();
+        return value
+
+    def readVectorHeader(self):
+        """ returns (count, None) for a new vector or (None, vector) for a reference """
+        ref = self.readUint29()
+        if (ref & 1) == 0:
+            return None, self.getObject(ref>>1)
+        fixed = self.readByte() == 1
+        return ref >> 1, None
+
+    def readNumberVector(self, count, structCode, arrayCode, size):
+        """ decodes a packed run of big-endian numbers in a single call """
+        pos = self.pos
+        end = pos + count*size
+        if end > len(self.data):
+            raise EOFError
+        self.pos = end
+        if self.vectorsAsArrays:
+            value = array(arrayCode, str(self.data[pos:end]))
+            if kLittleEndian:
+                value.byteswap()
+        else:
+            value = list(unpack_from('>%d%s' % (count, structCode), self.data, pos))
+        self.addObject(value);
+        return value
+
+    def decodeVectorInt(self):
+        count, value = self.readVectorHeader()
+        if count is None:
+            return value
+        return self.readNumberVector(count, 'I', kUint32Array, 4)
+
+    decodeVectorUint = decodeVectorInt
+
+    def decodeVectorDouble(self):
+        count, value = self.readVectorHeader()
+        if count is None:
+            return value
+        return self.readNumberVector(count, 'd', 'd', 8)
+
+    def decodeVectorObject(self):
+        count, value = self.readVectorHeader()
+        if count is not None:
+            value = []
+            self.addObject(value);
+            className = self.readAmfString(True);
+            readAmfObject = self.readAmfObject
+            for i in xrange(count):
+                value.append(readAmfObject());
+        return value
+
+    def readTraits(self, ref):
+        """ returns the traits for an object header, reading inline traits """
+        if ((ref & 3) == 1):
+            return self.traitsList[ref >> 2];
+        traits = {}
+        traits['dynamic'] = ((ref & 8) >> 3);
+        if ref & 4:
+            traits['externalizable'] = True
+        traits['count'] = ref >> 4
+        className = self.readAmfString(True)
+        if className and len(className) > 0:
+            traits['className'] = className
+        else : 
+            traits['className'] = ""
+        slots = [];
+        count = traits['count']
+        while (count):
+            slots.append(self.readAmfString(True))
+            count -= 1
+        traits['slots'] = slots
+        self.addTraits(traits)
+        return traits
+
+    def addTraits(self, traits):
+        self.traitsList.append(traits)
+        self.traitsDecoders.append(self.compileTraits(traits))
+
+    def compileTraits(self, traits):
+        """
+        builds a decoder specialised for one traits entry, so the objects that
+        reuse it are read without walking the traits again
+        """
+        if traits['dynamic'] == 1:
+            return partial(self.decodeDynamicObject, traits)
+        slots = traits['slots']
+        recordClass = None
+        if self.compactRecords:
+            # room for the id readRecord adds, left unset in nested objects
+            addId = self.nameIds and 'name' in slots and 'id' not in slots
+            recordClass = getRecordClass(traits['className'], slots + ['id'] if addId else slots)
+        if recordClass:
+            lines = ["    value = recordClass()"]
+            lines += ["    value.%s = read()" % slot for slot in slots]
         else:
-            print("invalid data type", encoding);
-            #throw new Error("invalid data stream");
-            value = None;
-        return value;
+            lines = ["    value = {}"]
+            lines += ["    value[%r] = read()" % slot for slot in slots]
+        # the object is registered before its slots are read, they may refer to it
+        lines.insert(1, "    addObject(value)")
+        source = "def decode():\n" + "\n".join(lines) + "\n    return value\n"
+        namespace = {'read':self.readAmfObject, 'addObject':self.addObject,
+                     'recordClass':recordClass}
+        exec source in namespace
+        return namespace['decode']
+
+    def decodeDynamicObject(self, traits):
+        value = {}
+        self.addObject(value);
+        readAmfObject = self.readAmfObject
+        for slot in traits['slots']:
+            value[slot] = readAmfObject()
+        s = self.readAmfString(True)
+        while s:
+            value[s] = readAmfObject()
+            s = self.readAmfString(True)
+        return value
+
+    def decodeObject(self):
+        ref = self.readUint29()
+        if (ref & 1) == 0: 
+            return self.getObject(ref>>1);
+        if (ref & 3) == 1:
+            return self.traitsDecoders[ref >> 2]()
+        self.readTraits(ref)
+        return self.traitsDecoders[-1]()
 
     # Examine data stream to find its format
     def getFormat(self):
         if (len(self.data)<1):
             return None
-        firstByte = ord(self.data[0])
+        firstByte = bytearray(self.data[0:1])[0]
         if firstByte == self.kObjectAtomType:
             self.format = "amfstream"   # raw stream from player
         elif firstByte == self.kArrayAtomType:
@@ -469,53 +712,353 @@ class amf3reader(dict):
         return self.format
             
     
+    def rewind(self, recordPos, traitsLen, stringCount):
+        """ drops a partially read record so it can be read again once more data arrives """
+        self.pos = recordPos; #rewind to start
+        self.traitsList = self.traitsList[0:traitsLen];
+        self.traitsDecoders = self.traitsDecoders[0:traitsLen];
+        self.skipRuns = {}
+        self.stringList = self.stringList[0:stringCount];
+
     def readMetric(self):
-        recordPos = self.pos; 
-        record = None;
+        """ returns the next metric, or None if the buffer ends before it does """
+        record = self.readRecord()
+        while record is kSkipped:
+            record = self.readRecord()
+        return record
+
+    def readRecord(self):
+        """ reads one record, returns kSkipped if the name filter rejected it """
         if self.flash11Mode:
-            # this is to support older telemetry, remove eventually
-            try:
-                name = self.readAmfString(True)
-            
-                if (self.verbose) : print "String=%s" % name;
-                if name.endswith(".span"):
-                    name = name.rsplit('.',1)[0] # strip the .span extension
-                    span = self.readAmfObject();
-                    tname = self.readAmfString(True);
-                    if (self.verbose) : print "String=%s" % tname;
-                    time = self.readAmfObject();
-                    if name is not None and tname is not None and tname.endswith(".time") \
-                        and span is not None and time is not None:
-                        record = {'name':name,"span":span,"time":time};
-                elif name.endswith(".time"):
-                    name = name.rsplit('.',1)[0] # strip unused types
-                    time = self.readAmfObject()
-                    if time:
-                        record = {'name':name,'time':time}
-                else:
-                    if name.endswith(".count"):
-                        name = name.rsplit('.',1)[0] # strip unused types
-                    record = {'name':name}
-                    record['value'] = self.readAmfObject();
-            except:
-                self.pos = recordPos; #rewind to start
-                name = None
+            # this is to support older telemetry
+            record = self.readOldStyleRecord()
         else:    
+            recordPos = self.pos; 
             traitsLen = len(self.traitsList)
             stringCount = len(self.stringList) 
             try:
-                record = self.readAmfObject();
+                if self.nameFilter:
+                    record = self.readFilteredObject()
+                else:
+                    record = self.readAmfObject();
             except EOFError:
-                if (self.verbose):
-                    print "Partial record warning"
-                self.pos = recordPos; #rewind to start
-                self.traitsList = self.traitsList[0:traitsLen];
-                self.stringList = self.stringList[0:stringCount];
+                self.rewind(recordPos, traitsLen, stringCount)
                 record = None;
             finally:
                 self.clearObjectsList();
+            if self.nameIds and record is not None:
+                self.addNameId(record)
+        if record is not None:
+            self.compact()
+        return record
+
+    def addNameId(self, record):
+        """ adds the symbols id of its name to a top level record, if the name is a string """
+        if isinstance(record, dict):
+            if type(record.get('name')) == str and 'id' not in record:
+                record['id'] = symbols.intern(record['name'])
+        elif isinstance(record, amf3record):
+            if 'id' in record.__slots__ and type(record.get('name')) == str and 'id' not in record:
+                record.id = symbols.intern(record.name)
+
+    # old style (flash11) records
+    # Each record is a name without a marker followed by its value. The suffix
+    # of the name gives its kind: a '.span' name is followed by the span, then
+    # a '.time' name and the end time. Names are sent by reference once seen,
+    # so each one is only classified once, in oldStyleNames.
+
+    def readOldStyleRecord(self):
+        """ reads an old style record, returns None if the buffer ends before it does """
+        recordPos = self.pos
+        traitsLen = len(self.traitsList)
+        stringCount = len(self.stringList)
+        try:
+            kind, name, nameId = self.readOldStyleName()
+            if kind == kOldStyleSpan:
+                span = self.readAmfObject()
+                if self.readOldStyleName()[0] != kOldStyleTime:
+                    raise ValueError("old style span %s.span is not followed by its .time" % name)
+                record = {'name':name, 'span':span, 'time':self.readAmfObject()}
+            elif kind == kOldStyleTime:
+                record = {'name':name, 'time':self.readAmfObject()}
+            else:
+                record = {'name':name, 'value':self.readAmfObject()}
+        except EOFError:
+            self.rewind(recordPos, traitsLen, stringCount)
+            return None
+        finally:
+            self.clearObjectsList()
+        if self.nameFilter and not self.nameFilter(name):
+            return kSkipped
+        if self.nameIds:
+            record['id'] = nameId
+        if self.compactRecords:
+            # the same shape as a modern record with these slots
+            recordClass = getRecordClass("", kOldStyleFields[kind] + ('id',) * self.nameIds)
+            value = recordClass()
+            for field, fieldValue in record.iteritems():
+                setattr(value, field, fieldValue)
+            record = value
         return record
 
+    def readOldStyleName(self):
+        """ reads a record name, returns (kind, name less its suffix, symbols id or None) """
+        name = self.readAmfString(True)
+        entry = self.oldStyleNames.get(name)
+        if entry is None:
+            kind = kOldStyleValue
+            baseName = name
+            for suffix, suffixKind in kOldStyleSuffixes:
+                if name.endswith(suffix):
+                    kind = suffixKind
+                    baseName = name[:-len(suffix)]
+                    break
+            nameId = None
+            if self.nameIds:
+                nameId = symbols.intern(baseName)
+            entry = self.oldStyleNames[name] = (kind, baseName, nameId)
+        return entry
+
+    # selective decoding
+    # readFilteredObject reads just the name of each record and steps over the
+    # rest of a rejected record with skipValue. Skipped values still add their
+    # strings and traits to the reference tables, later records refer to them.
+
+    def readFilteredObject(self):
+        """ reads a record, returns kSkipped without decoding it if its name is filtered out """
+        recordPos = self.pos
+        if recordPos + 5 <= len(self.data):
+            # fast path for short references to known traits and the name
+            marker, ref, stringMarker, stringRef, byte = kRecordHeader.unpack_from(self.data, recordPos)
+            slotsPos = recordPos + 4
+            shortRef = stringRef < 128 or byte < 128
+            if stringRef >= 128 and byte < 128:
+                stringRef = ((stringRef & 0x7F) << 7) | byte
+                slotsPos += 1
+            # name references of three or four bytes take the slow path
+            if marker == self.kObjectAtomType and stringMarker == self.kStringAtomType \
+                and ref < 128 and (ref & 3) == 1 and shortRef and (stringRef & 1) == 0:
+                traits = self.traitsList[ref >> 2]
+                slots = traits['slots']
+                if slots and slots[0] == 'name':
+                    if self.nameFilter(self.stringList[stringRef >> 1]):
+                        record = self.readAmfObject()
+                        if self.skippedDelta:
+                            self.passSkippedDelta(record)
+                        return record
+                    self.pos = slotsPos
+                    return self.skipRecord(ref >> 2)
+        if self.peekByte() != self.kObjectAtomType:
+            return self.readAmfObject()
+        self.pos += 1
+        ref = self.readUint29()
+        if (ref & 3) == 1:
+            index = ref >> 2
+            traits = self.traitsList[index]
+        elif ref & 1:
+            traits = self.readTraits(ref)
+            index = len(self.traitsList) - 1
+        else:
+            self.pos = recordPos
+            return self.readAmfObject()
+        slots = traits['slots']
+        if not slots or slots[0] != 'name':
+            return self.traitsDecoders[index]()
+        slotsPos = self.pos
+        stringCount = len(self.stringList)
+        name = self.readAmfObject()
+        if self.nameFilter(name):
+            # read it again as a whole record, without adding the name twice
+            del self.stringList[stringCount:]
+            self.pos = slotsPos
+            record = self.traitsDecoders[index]()
+            if self.skippedDelta:
+                self.passSkippedDelta(record)
+            return record
+        return self.skipRecord(index)
+
+    def skipRecord(self, index):
+        """ steps over the slots after the name """
+        # the delta times of skipped records are passed on with the next
+        # record returned so a running clock kept from them stays right
+        traits = self.traitsList[index]
+        run = self.skipRuns.get(index, False)
+        if run is False:
+            run = self.skipRuns[index] = getSkipRun(traits)
+        if run:
+            match = run.match(self.data, self.pos)
+            if match:
+                self.pos = match.end()
+                if match.lastindex:
+                    value = bytearray(match.group(1))
+                    if len(value) == 1:
+                        self.skippedDelta += value[0]
+                    else:
+                        self.skippedDelta += ((value[0] & 0x7F) << 7) | value[1]
+                return kSkipped
+        slots = traits['slots']
+        delta = 0
+        count = len(slots) - 1
+        if 'delta' in slots:
+            before = slots.index('delta') - 1
+            self.skipValues(before)
+            value = self.readAmfObject()
+            if type(value) in (int, float):
+                delta = value
+            self.skipValues(count - before - 1)
+        else:
+            self.skipValues(count)
+        if traits['dynamic']:
+            while self.readAmfString(True):
+                self.skipValue()
+        self.skippedDelta += delta
+        return kSkipped
+
+    def passSkippedDelta(self, record):
+        """ adds the delta time of the records skipped before this one to it """
+        delta = record.get('delta')
+        if type(delta) in (int, float):
+            record['delta'] = delta + self.skippedDelta
+        elif type(record) == dict and 'time' not in record:
+            record['delta'] = self.skippedDelta
+        else:
+            return  # no place for it here, keep it for the next record
+        self.skippedDelta = 0
+
+    def skipBytes(self, length):
+        pos = self.pos + length
+        if pos > len(self.data):
+            raise EOFError
+        self.pos = pos
+
+    def skipValues(self, count):
+        """ steps over count values, matching a run of scalars in one go """
+        if count:
+            match = getScalarRun(count).match(self.data, self.pos)
+            if match:
+                self.pos = match.end()
+            else:
+                for i in xrange(count):
+                    self.skipValue()
+
+    def skipValue(self):
+        """ steps over one value without building it """
+        marker = self.readByte()
+        if marker == self.kStringAtomType:
+            self.readAmfString(True)
+        elif marker == self.kIntegerAtomType:
+            self.readUint29()
+        elif marker == self.kDoubleAtomType:
+            self.skipBytes(8)
+        elif marker == self.kObjectAtomType:
+            ref = self.readUint29()
+            if ref & 1:
+                traits = self.readTraits(ref)
+                self.skipValues(len(traits['slots']))
+                if traits['dynamic']:
+                    while self.readAmfString(True):
+                        self.skipValue()
+        elif marker == self.kArrayAtomType:
+            ref = self.readUint29()
+            if ref & 1:
+                while self.readAmfString(True):
+                    self.skipValue()
+                self.skipValues(ref >> 1)
+        elif marker == self.kDictionaryObjectType:
+            ref = self.readUint29()
+            if ref & 1:
+                self.skipBytes(1) # weak keys
+                self.skipValues(2*(ref >> 1))
+        elif marker == self.kTypedVectorObjectType:
+            ref = self.readUint29()
+            if ref & 1:
+                self.skipBytes(1) # fixed
+                self.readAmfString(True) # class name
+                self.skipValues(ref >> 1)
+        elif marker in (self.kTypedVectorIntType, self.kTypedVectorUintType):
+            ref = self.readUint29()
+            if ref & 1:
+                self.skipBytes(1 + 4*(ref >> 1))
+        elif marker == self.kTypedVectorDoubleType:
+            ref = self.readUint29()
+            if ref & 1:
+                self.skipBytes(1 + 8*(ref >> 1))
+        elif marker == self.kDateAtomType:
+            ref = self.readUint29()
+            if ref & 1:
+                self.skipBytes(8)
+        elif marker in (self.kAvmMinusXmlAtomType, self.kAvmPlusXmlAtomType,
+                        self.kByteArrayAtomType):
+            ref = self.readUint29()
+            if ref & 1:
+                self.skipBytes(ref >> 1)
+        elif marker > self.kDictionaryObjectType:
+            self.decodeInvalid(marker)
+
+    def scanChunks(self, chunkSize):
+        """
+        steps over the records from pos to the end of the buffer without
+        decoding them, filling in the string and traits tables. Returns
+        (offset, string count, traits count) at a record boundary about every
+        chunkSize bytes, the state a reader needs to start decoding there
+        """
+        checkpoints = []
+        nameFilter = self.nameFilter
+        self.nameFilter = rejectAll
+        recordRun = None
+        traitsCount = -1
+        nextCheckpoint = self.tell()
+        try:
+            while self.pos < len(self.data):
+                offset = self.tell()
+                if offset >= nextCheckpoint:
+                    checkpoints.append((offset, len(self.stringList), len(self.traitsList)))
+                    nextCheckpoint = offset + chunkSize
+                if traitsCount != len(self.traitsList):
+                    traitsCount = len(self.traitsList)
+                    recordRun = getRecordRun(self.traitsList)
+                if recordRun:
+                    # most records are matched here in runs, stopping at the checkpoint
+                    end = min(len(self.data), self.pos + nextCheckpoint - offset)
+                    match = recordRun.match(self.data, self.pos, end)
+                    if match:
+                        self.pos = match.end()
+                        continue
+                if self.readRecord() is None:
+                    break
+        finally:
+            self.nameFilter = nameFilter
+            self.skippedDelta = 0
+        return checkpoints
+
+    def seekRecord(self, index, record):
+        """
+        moves to the start of a record listed in an amf3index, restoring the
+        string and traits tables as they were there. Restores the nearest
+        checkpoint and reads forward from it, the records must still be in
+        the buffer (e.g. an amf3mappedreader over the indexed file)
+        """
+        checkpoint = index.getCheckpoint(record)
+        start = index.checkRecords[checkpoint]
+        self.pos = int(index.offsets[start]) - self.base
+        self.stringList = index.strings[:index.stringCounts[checkpoint]]
+        self.traitsList = []
+        self.traitsDecoders = []
+        self.skipRuns = {}
+        for traits in index.traits[:index.traitsCounts[checkpoint]]:
+            self.addTraits(traits)
+        self.objectsList = []
+        self.scanStack = None
+        for i in xrange(record - start):
+            self.readRecord()
+        self.skippedDelta = 0   # the index times already include them
+
+    def readMetrics(self):
+        """ yields each complete metric already in the buffer """
+        metric = self.readMetric()
+        while metric:
+            yield metric
+            metric = self.readMetric()
 
     # reads the entire buffer as one array of objects
     def unpack(self):
@@ -527,21 +1070,940 @@ class amf3reader(dict):
 
         if (rec):
             output.append(rec);
-        return output 
+        return output
+
+    # incremental (push) parsing
+    # feed() decodes each record straight away and rewinds if the buffer ends
+    # inside it. Only that last, partial record is then checked by scanRecord,
+    # which walks just the value headers and keeps its place between calls, so
+    # a record arriving in many small pieces is still decoded once it is whole.
+    # With scanFirst every record is scanned before it is decoded.
+
+    def feed(self, data):
+        """ adds data and returns the list of metrics it completed """
+        self.addData(data)
+        metrics = []
+        if self.flash11Mode:
+            # old style records are a name and a scalar or two, just retry them
+            record = self.readMetric()
+            while record is not None:
+                metrics.append(record)
+                record = self.readMetric()
+            return metrics
+        while self.pos < len(self.data):
+            if self.scanStack is None and not self.scanFirst:
+                recordPos = self.pos
+                record = self.readRecord()
+                if record is None and self.pos == recordPos:
+                    # cut off, wait until scanRecord finds the rest has arrived
+                    if not self.scanRecord():
+                        break
+                    record = self.readRecord()
+                    if record is None and self.pos == recordPos:
+                        break
+            elif self.scanRecord():
+                record = self.readRecord()
+            else:
+                break
+            if record is not None and record is not kSkipped:
+                metrics.append(record)
+        return metrics
+
+    def scanRecord(self):
+        """ returns True once the whole record at pos is in the buffer """
+        stack = self.scanStack
+        if stack is None:
+            # each frame is [values left, reading dynamic keys, dense values after the keys]
+            stack = self.scanStack = [[1, 0, 0]]
+            self.scanPos = self.pos
+            self.scanTraits = []
+        p = self.scanPos
+        try:
+            while stack:
+                frame = stack[-1]
+                if frame[1]:
+                    empty, p = self.scanString(p)
+                    if not empty:
+                        stack.append([1, 0, 0])
+                    elif frame[2]:
+                        frame[0] = frame[2]
+                        frame[1] = frame[2] = 0
+                    else:
+                        stack.pop()
+                elif frame[0]:
+                    p = self.scanValue(p, stack)
+                    frame[0] -= 1
+                else:
+                    stack.pop()
+        except EOFError:
+            self.scanPos = p    # resume from the last complete header
+            return False
+        self.scanStack = None
+        return True
+
+    def scanUint29(self, p):
+        data = self.data
+        if p+4 > len(data):
+            # only check byte by byte near the end of the buffer
+            value = 0
+            for i in range(3):
+                if p >= len(data):
+                    raise EOFError
+                byte = data[p]
+                p += 1
+                if byte < 128:
+                    return (value << 7) | byte, p
+                value = (value << 7) | (byte & 0x7F)
+            if p >= len(data):
+                raise EOFError
+            return (value << 8) | data[p], p + 1
+        byte = data[p]
+        if byte < 128:
+            return byte, p + 1
+        value = byte & 0x7F
+        byte = data[p+1]
+        if byte < 128:
+            return (value << 7) | byte, p + 2
+        value = (value << 7) | (byte & 0x7F)
+        byte = data[p+2]
+        if byte < 128:
+            return (value << 7) | byte, p + 3
+        value = (value << 7) | (byte & 0x7F)
+        return (value << 8) | data[p+3], p + 4
+
+    def scanString(self, p):
+        """ skips a string, returns (is empty, position after it) """
+        ref, p = self.scanUint29(p)
+        if ref & 1:
+            p += ref >> 1
+            if p > len(self.data):
+                raise EOFError
+        return ref == 1, p
+
+    def scanSkip(self, p, length):
+        p += length
+        if p > len(self.data):
+            raise EOFError
+        return p
+
+    def scanValue(self, p, stack):
+        """ skips one value header, pushing a frame for any nested values """
+        if p >= len(self.data):
+            raise EOFError
+        marker = self.data[p]
+        p += 1
+        if marker == self.kObjectAtomType:
+            ref, p = self.scanUint29(p)
+            if ref & 1:
+                if (ref & 3) == 1:
+                    index = ref >> 2
+                    traitsList = self.traitsList
+                    if index < len(traitsList):
+                        traits = traitsList[index]
+                        count, dynamic = len(traits['slots']), traits['dynamic']
+                    else:
+                        count, dynamic = self.scanTraits[index - len(traitsList)]
+                else:
+                    count, dynamic = ref >> 4, (ref & 8) >> 3
+                    empty, p = self.scanString(p) # class name
+                    for i in xrange(count):
+                        empty, p = self.scanString(p)
+                    self.scanTraits.append((count, dynamic))
+                if dynamic:
+                    stack.append([0, 1, 0])
+                if count:
+                    stack.append([count, 0, 0])
+        elif marker == self.kStringAtomType:
+            empty, p = self.scanString(p)
+        elif marker == self.kIntegerAtomType:
+            ref, p = self.scanUint29(p)
+        elif marker == self.kDoubleAtomType:
+            p = self.scanSkip(p, 8)
+        elif marker == self.kArrayAtomType:
+            ref, p = self.scanUint29(p)
+            if ref & 1:
+                stack.append([0, 1, ref >> 1])
+        elif marker == self.kDictionaryObjectType:
+            ref, p = self.scanUint29(p)
+            if ref & 1:
+                p = self.scanSkip(p, 1) # weak keys
+                if ref >> 1:
+                    stack.append([2*(ref >> 1), 0, 0])
+        elif marker == self.kTypedVectorObjectType:
+            ref, p = self.scanUint29(p)
+            if ref & 1:
+                p = self.scanSkip(p, 1) # fixed
+                empty, p = self.scanString(p) # class name
+                if ref >> 1:
+                    stack.append([ref >> 1, 0, 0])
+        elif marker in (self.kTypedVectorIntType, self.kTypedVectorUintType):
+            ref, p = self.scanUint29(p)
+            if ref & 1:
+                p = self.scanSkip(p, 1 + 4*(ref >> 1))
+        elif marker == self.kTypedVectorDoubleType:
+            ref, p = self.scanUint29(p)
+            if ref & 1:
+                p = self.scanSkip(p, 1 + 8*(ref >> 1))
+        elif marker == self.kDateAtomType:
+            ref, p = self.scanUint29(p)
+            if ref & 1:
+                p = self.scanSkip(p, 8)
+        elif marker in (self.kAvmMinusXmlAtomType, self.kAvmPlusXmlAtomType,
+                        self.kByteArrayAtomType):
+            ref, p = self.scanUint29(p)
+            if ref & 1:
+                p = self.scanSkip(p, ref >> 1)
+        return p
+
+
+def iter_metrics(fileobj, chunk_size=kChunkSize, reader=None):
+    """
+    Reads fileobj in chunk_size pieces and yields one metric at a time,
+    so memory use follows the largest record rather than the file size
+    Pass a reader to choose the decoder or to inspect its format afterwards
+    """
+    if reader is None:
+        reader = amf3reader()
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        for metric in reader.feed(chunk):
+            yield metric
+    if reader.pos < len(reader.data):
+        # a record cut off at the end of the file, readMetric reports and drops it
+        metric = reader.readMetric()
+        if metric is not None:
+            yield metric
+
+def jsonValue(value):
+    """ converts the values json doesn't know about, used as its default """
+    if isinstance(value, amf3record):
+        return value.asDict()
+    if isinstance(value, array):
+        return value.tolist()
+    raise TypeError(repr(value) + " is not JSON serializable")
+
+def jsonFinite(value):
+    """ value with its NaN and infinite floats replaced by None, JSON has no such numbers """
+    if isinstance(value, float):
+        return None if isnan(value) or isinf(value) else value
+    if isinstance(value, amf3record):
+        value = value.asDict()
+    if isinstance(value, dict):
+        return dict((key, jsonFinite(item)) for key, item in value.iteritems())
+    if isinstance(value, (list, tuple, array)):
+        return [jsonFinite(item) for item in value]
+    return value
+
+def makeJsonDumps(fast=False):
+    """
+    returns a function giving one metric as a line of compact JSON
+    fast uses ujson when it is installed, which is several times quicker
+    but doesn't know amf3record or array values
+    """
+    if fast:
+        try:
+            import ujson
+            return ujson.dumps
+        except ImportError:
+            pass
+    import json
+    return json.JSONEncoder(separators=(',', ':'), default=jsonValue, allow_nan=False).encode
+
+def export_json(fileobj, out, fast=False, reader=None):
+    """
+    Writes each metric in fileobj to out as a line of JSON (NDJSON) as soon
+    as it is decoded, so memory use stays flat however long the capture
+    Returns the number of metrics written
+    """
+    import json
+    dumps = makeJsonDumps(fast)
+    # for strings that aren't utf-8, and values the fast encoder refuses
+    encode = json.JSONEncoder(separators=(',', ':'), default=jsonValue, encoding='latin-1',
+                              allow_nan=False).encode
+    def fallback(metric):
+        try:
+            return encode(metric)
+        except ValueError:
+            # NaN or Infinity, written as null
+            return encode(jsonFinite(metric))
+    write = out.write
+    count = 0
+    for metric in iter_metrics(fileobj, reader=reader):
+        try:
+            line = dumps(metric)
+        except (UnicodeDecodeError, OverflowError, TypeError, ValueError):
+            line = fallback(metric)
+        write(line + '\n')
+        count += 1
+    return count
+
+
+class amf3mappedreader(amf3reader):
+    """
+    Reads a capture already on disk through a read-only mmap instead of
+    copying it into a buffer. Processes analysing the same file share the
+    page cache rather than each holding a private copy.
+    Use readMetrics or unpack, the whole file is already available.
+    """
+
+    def __init__(self, fileobj):
+        amf3reader.__init__(self)
+        self.mapped = None
+        if os.fstat(fileobj.fileno()).st_size:   # empty files can't be mapped
+            self.mapped = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            self.setData(self.mapped)
+
+    def setData(self, data):
+        self.startData(data)
+
+    def close(self):
+        if self.mapped:
+            self.mapped.close()
+            self.mapped = None
+        self.data = bytearray()
+        self.pos = 0
+
+    def compact(self):
+        pass    # nothing to discard, the whole file is mapped
+
+    def peekByte(self):
+        if (self.pos < len(self.data)):
+            return ord(self.data[self.pos])
+        else:
+            return None
+
+    def readByte(self):
+        pos = self.pos
+        if pos < len(self.data):
+            self.pos = pos + 1
+            return ord(self.data[pos])
+        raise EOFError
+
+
+# Parallel decoding
+# The string and traits tables grow across the whole stream (objectsList is
+# cleared for each record), so a chunk can be decoded on its own given the
+# table sizes at its start. Phase one (scanChunks) finds record boundaries and
+# those sizes without decoding, phase two decodes the chunks in a process pool.
+
+kParallelChunks = 4   # chunks per process, to even out the load
+
+parallelReader = None   # the reader of each pool process, set by initParallel
+
+def initParallel(filename, strings, traits):
+    global parallelReader
+    parallelReader = amf3mappedreader(open(filename, 'rb'))
+    parallelReader.allStrings = strings
+    parallelReader.allTraits = traits
+    parallelReader.allDecoders = [parallelReader.compileTraits(entry) for entry in traits]
+
+def decodeChunk(chunk):
+    """ decodes the records from start to end, with the tables as they were at start """
+    start, end, stringCount, traitsCount = chunk
+    reader = parallelReader
+    reader.stringList = reader.allStrings[:stringCount]
+    reader.traitsList = reader.allTraits[:traitsCount]
+    reader.traitsDecoders = reader.allDecoders[:traitsCount]
+    reader.pos = start
+    metrics = []
+    while reader.pos < end:
+        metric = reader.readMetric()
+        if metric is None:
+            break
+        metrics.append(metric)
+    return metrics
+
+def iter_metrics_parallel(filename, processes=None, chunk_size=None):
+    """
+    Decodes filename with a pool of processes (one per cpu by default) and
+    yields its metrics in order. Only raw amfstream captures can be split,
+    others are decoded here as usual. The metrics are plain dicts
+    """
+    from multiprocessing import Pool, cpu_count
+    if processes is None:
+        processes = cpu_count()
+    f = open(filename, 'rb')
+    reader = amf3mappedreader(f)
+    if reader.format != "amfstream" or processes < 2:
+        for metric in reader.readMetrics():
+            yield metric
+        reader.close()
+        f.close()
+        return
+    size = len(reader.data)
+    if chunk_size is None:
+        chunk_size = max(kChunkSize, size / (processes * kParallelChunks))
+    checkpoints = reader.scanChunks(chunk_size)
+    strings, traits = reader.stringList, reader.traitsList
+    reader.close()
+    f.close()
+    chunks = []
+    for i, (offset, stringCount, traitsCount) in enumerate(checkpoints):
+        end = checkpoints[i+1][0] if i+1 < len(checkpoints) else size
+        chunks.append((offset, end, stringCount, traitsCount))
+    pool = Pool(min(processes, len(chunks)), initParallel, (filename, strings, traits))
+    try:
+        for metrics in pool.imap(decodeChunk, chunks):
+            for metric in metrics:
+                yield metric
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# Sidecar index (e.g. log3.flm.idx) for random access into a capture.
+# It keeps the byte offset and telemetry time of every record, the record
+# numbers of the frame markers, and checkpoints of the reader state at
+# every frame marker and every kCheckpointInterval records: the string and
+# traits table sizes and the running 'delta' clock before the record.
+# The tables only grow, so the final tables plus the sizes restore them.
+
+kIndexVersion = 1
+kFrameMarker = '.swf.frame'
+kCheckpointInterval = 1024
+
+class amf3index(object):
+    """ record offsets, times, frame markers and table checkpoints of one capture """
+
+    def __init__(self, marker=kFrameMarker):
+        self.marker = marker
+        self.size = 0
+        self.mtime = 0
+        self.offsets = array('d')      # byte offset of each record
+        self.times = array('d')        # telemetry time of each record
+        self.frames = array('I')       # record number of each frame marker
+        self.checkRecords = array('I') # record number of each checkpoint
+        self.stringCounts = array('I') # stringList length at each checkpoint
+        self.traitsCounts = array('I') # traitsList length at each checkpoint
+        self.clocks = array('d')       # sum of 'delta' times before each checkpoint
+        self.strings = []
+        self.traits = []
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def frameRecord(self, frame):
+        """ record number of frame marker #frame (0 based) """
+        return self.frames[frame]
+
+    def timeRecord(self, time):
+        """ number of the first record at or after time """
+        return bisect.bisect_left(self.times, time)
+
+    def getCheckpoint(self, record):
+        """ index of the last checkpoint at or before record """
+        return bisect.bisect_right(self.checkRecords, record) - 1
+
+    def isCurrent(self, filename):
+        stat = os.stat(filename)
+        return stat.st_size == self.size and stat.st_mtime == self.mtime
+
+    def save(self, path):
+        arrays = {}
+        for name in ('offsets', 'times', 'frames', 'checkRecords', 'stringCounts',
+                     'traitsCounts', 'clocks'):
+            values = array(getattr(self, name).typecode, getattr(self, name))
+            if not kLittleEndian:
+                values.byteswap()
+            arrays[name] = values.tostring()
+        f = open(path, 'wb')
+        marshal.dump({'version':kIndexVersion, 'marker':self.marker, 'size':self.size,
+                      'mtime':self.mtime, 'arrays':arrays, 'strings':self.strings,
+                      'traits':self.traits}, f)
+        f.close()
+
+    @classmethod
+    def load(cls, path):
+        """ reads an index saved by save, None if it is missing or unreadable """
+        try:
+            f = open(path, 'rb')
+            try:
+                state = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if type(state) != dict or state.get('version') != kIndexVersion:
+            return None
+        index = cls(state['marker'])
+        index.size = state['size']
+        index.mtime = state['mtime']
+        index.strings = state['strings']
+        index.traits = state['traits']
+        for name, data in state['arrays'].items():
+            values = getattr(index, name)
+            values.fromstring(data)
+            if not kLittleEndian:
+                values.byteswap()
+        return index
+
+
+def buildIndex(filename, marker=kFrameMarker):
+    """ decodes filename once and returns its amf3index """
+    index = amf3index(marker)
+    stat = os.stat(filename)
+    index.size = stat.st_size
+    index.mtime = stat.st_mtime
+    f = open(filename, 'rb')
+    reader = amf3mappedreader(f)
+    time = clock = 0
+    while True:
+        record = len(index.offsets)
+        offset = reader.tell()
+        stringCount = len(reader.stringList)
+        traitsCount = len(reader.traitsList)
+        lastClock = clock
+        metric = reader.readMetric()
+        if not metric:
+            break
+        isMarker = False
+        if isinstance(metric, dict) or isinstance(metric, amf3record):
+            delta = metric.get('delta')
+            if isinstance(delta, (int, long, float)):
+                clock += delta
+                time = clock
+            elif metric.has_key('time'):
+                time = metric['time']
+            isMarker = metric.get('name') == marker
+        if isMarker:
+            index.frames.append(record)
+        if isMarker or record % kCheckpointInterval == 0:
+            index.checkRecords.append(record)
+            index.stringCounts.append(stringCount)
+            index.traitsCounts.append(traitsCount)
+            index.clocks.append(lastClock)
+        index.offsets.append(offset)
+        index.times.append(time)
+    index.strings = reader.stringList
+    index.traits = [dict(traits) for traits in reader.traitsList]
+    reader.close()
+    f.close()
+    return index
+
+
+def openIndex(filename, marker=kFrameMarker):
+    """ loads filename.idx, building and saving it first if it is missing or stale """
+    path = filename + ".idx"
+    index = amf3index.load(path)
+    if index is None or index.marker != marker or not index.isCurrent(filename):
+        index = buildIndex(filename, marker)
+        try:
+            index.save(path)
+        except IOError:
+            pass    # read-only location, use the index for this run only
+    return index
+
+
+class amf3tracer(amf3reader):
+    """
+    amf3reader that prints a hex dump and a description of each value as it
+    is decoded (telemetry.py -d). Kept separate so the default decoder does
+    not pay for the tracing.
+    """
+
+    verbose = True
+    scanFirst = True    # a record cut off by a chunk would be traced twice
+
+    def makeDecoders(self):
+        decoders = amf3reader.makeDecoders(self)
+        decoders[self.kAvmMinusXmlAtomType] = partial(self.decodeXml, "- ")
+        decoders[self.kAvmPlusXmlAtomType] = partial(self.decodeXml, "+ ")
+        for encoding, kind in ((self.kTypedVectorIntType, "Vector Int"),
+                               (self.kTypedVectorUintType, "Vector Uint"),
+                               (self.kTypedVectorDoubleType, "Vector Double"),
+                               (self.kTypedVectorObjectType, "Vector Object")):
+            decoders[encoding] = partial(self.decodeVector, encoding, kind)
+        return decoders
+
+    def printHex(self,count):
+         if self.pos+count <= len(self.data):
+             print ByteToHex(self.data[self.pos:self.pos+count]), 
+
+    def readByte(self):
+        self.printHex(1)
+        return amf3reader.readByte(self)
+
+    def readDouble(self):
+        self.printHex(8)
+        return amf3reader.readDouble(self)
+
+    def readBytes(self,length):
+        print "bytes: ",
+        self.printHex(length)
+        val = amf3reader.readBytes(self, length)
+        print ""; # Move to next line (self.printHex above would have printed all bytes)
+        return val
+
+    def readAmfString(self, stringWithoutMarker, noCache=False):
+        if stringWithoutMarker:
+            print "String(wm) ",
+        ref = self.readUint29()
+        if (ref & 1) == 0:
+            print "Ref: %d" %(ref>>1),
+            return self.getString(ref >> 1);
+        length = ref >> 1;
+        if length == 0:
+            return ""
+        print " (%d) Len: %d" % (len(self.stringList), (ref>>1)),
+        s = self.readBytes(length)
+        if not noCache:  # for flash11 support
+            self.addString(s)
+        return s
+
+    def rewind(self, recordPos, traitsLen, stringCount):
+        print "Partial record warning"
+        amf3reader.rewind(self, recordPos, traitsLen, stringCount)
+
+    def decodeUndefined(self):
+        print "Undefined"
+
+    def decodeNull(self):
+        print "Null"
+
+    def decodeFalse(self):
+        print "False"
+        return False
+
+    def decodeTrue(self):
+        print "True"
+        return True
+
+    def decodeInteger(self):
+        value = self.readUint29(); 
+        print "Int29=%d" % value;
+        return value
+
+    def decodeDouble(self):
+        value = self.readDouble(); 
+        print "Double=%g" % value;
+        return value
+
+    def decodeString(self):
+        print "String ",
+        value = self.readAmfString(False, self.flash11Mode);
+        print " \"%s\"" % value;
+        return value
+
+    def decodeDate(self):
+        ref = self.readUint29()
+        print "Date ",
+        if (ref & 1) == 0:
+            value = self.getObject(ref>>1);
+            print "Ref: " + str(ref>>1);
+        else:
+            print "(%d)" % len(self.objectsList);
+            value = self.readDouble(); # dates are written as doubles
+            print " " + str(value) + " " + datetime.fromtimestamp(value/1000).isoformat();
+            self.addObject(value);
+        return value
+
+    def decodeXml(self, kind):
+        ref = self.readUint29()
+        print "XML ",
+        print kind,
+        if (ref & 1) == 0:
+            value = self.getObject(ref>>1);
+            print "Ref: " + str(ref>>1);
+        else:
+            print "(%d)" % len(self.objectsList);
+            self.printHex(ref >> 1)
+            value = self.readBytes(ref >> 1); # return as string for now
+            print value.encode()
+            self.addObject(value);
+        return value
+
+    def decodeByteArray(self):
+        ref = self.readUint29();
+        print "ByteArray ",
+        if (ref & 1) == 0:
+            value = self.getObject(ref>>1);
+            print "Ref: " + str(ref>>1)
+        else:
+            print "count: " + str(ref>>1);
+            value = self.readBytes(ref>>1);
+            self.addObject(value);
+        return value
+
+    def decodeDictionary(self):
+        ref = self.readUint29()
+        print "Dictionary ",
+        if (ref & 1) == 0:
+            value = self.getObject(ref>>1);
+            print "Ref: " + str(ref>>1);
+        else:
+            print "(%d)" % len(self.objectsList) ,
+            print " count: %d" %(ref>>1);
+            weakref = self.readByte() == 1
+            print "weakRef";
+            count = ref >> 1
+            value = {}
+            self.addObject(value);
+            while count > 0:
+                key = self.readAmfObject()
+                val = self.readAmfObject()
+                value[str(key)] = val
+                count -= 1
+            print '\n',
+        return value
+
+    def decodeArray(self):
+        value = {}
+        ref = self.readUint29()
+        print "Array ",
+        if (ref & 1) == 0 :
+            value = self.getObject(ref>>1);
+            print "Ref: " + str(ref);
+        else :
+            print "(%d)" % len(self.objectsList)
+            print "count: %d" % (ref>>1);
+            self.addObject(value);
+            count = ref >> 1
+            # read the non-dense portion
+            s = self.readAmfString(True)
+            while  s and len(s)>0:
+                print "%s (dyn)" % (s)
+                v = self.readAmfObject()
+                value[s] = v
+                s = self.readAmfString(True)
+                print ""
+            #now read the dense portion
+            i = 0
+            while i < count:
+                print "[%d]" % i
+                value[i] = self.readAmfObject();
+                i += 1
+            print '\n',
+        return value
+
+    def decodeVector(self, encoding, kind):
+        ref = self.readUint29()
+        print kind,
+        if (ref & 1) == 0:
+            value = self.getObject(ref>>1);
+            print " Ref: " + str(ref>>1);
+        else:
+            count = ref >> 1
+            print "length = %d" % count
+            fixed = self.readByte() == 1
+            print "fixed"
+            value = []
+            self.addObject(value);
+            if (encoding == self.kTypedVectorIntType or encoding == self.kTypedVectorUintType):
+                while(count > 0):
+                    self.printHex(4)
+                    value.append(self.readInt())
+                    count -= 1
+                    print " "
+                print value
+            elif encoding == self.kTypedVectorDoubleType:
+                while(count > 0):
+                    value.append(self.readDouble())
+                    count -= 1
+            elif encoding == self.kTypedVectorObjectType:
+                className = self.readAmfString(True);
+                print "ClassName = %s" % className
+                while (count > 0):
+                    value.append(self.readAmfObject());
+                    count -= 1
+            print '\n',
+        return value
+
+    def readTraits(self, ref):
+        if ((ref & 3) == 1):
+            print "Traits Ref: " + str(ref>>2) + " (class: %s slots: %d dynamic: %d)" %(self.traitsList[ref>>2]['className'], len(self.traitsList[ref>>2]['slots']), self.traitsList[ref>>2]['dynamic']);
+            return self.traitsList[ref >> 2];
+        traits = {}
+        traits['dynamic'] = ((ref & 8) >> 3);
+        if ref & 4:
+            traits['externalizable'] = True
+        traits['count'] = ref >> 4
+        print "Traits (%d) slots: %d dynamic: %d" % (len(self.traitsList), (ref>>4), ((ref & 8) >> 3))
+        className = self.readAmfString(True)
+        print "class: " + className
+        if className and len(className) > 0:
+            traits['className'] = className
+        else : 
+            traits['className'] = ""
+        slots = [];
+        count = traits['count']
+        while (count):
+            slots.append(self.readAmfString(True))
+            print slots[len(slots)-1]
+            count -= 1
+        traits['slots'] = slots
+        self.addTraits(traits)
+        return traits
+
+    def decodeObject(self):
+        ref = self.readUint29()
+        print "Object ",
+        if (ref & 1) == 0: 
+            value = self.getObject(ref>>1);
+            print "Ref: " + str(ref>>1);
+            return value
+        print "(%d)" % len(self.objectsList),
+        traits = self.readTraits(ref)
+        value = {}
+        self.addObject(value);
+        for slot in traits['slots']:
+            value[slot] = self.readAmfObject()
+        if (traits['dynamic'] == 1):
+            s = self.readAmfString(True)
+            while  s and len(s)>0:
+                print "%s (dyn)" % (s)
+                v = self.readAmfObject()
+                value[s] = v
+                s = self.readAmfString(True)
+        print '\n',
+        return value
+
+
+class amf3profiler(amf3reader):
+    """
+    amf3reader that counts what it decodes: for each type marker the values
+    decoded, the bytes they took and the time spent, not counting the values
+    nested in them (which count under their own type). Also counts reference
+    hits and misses for strings, traits and objects, and rewinds (each time
+    the data ran out inside a record). Records are scanned before they are
+    decoded, so the counts only hold complete decodes. Kept separate so the
+    default decoder does not pay for it.
+    """
+
+    scanFirst = True
+
+    def __init__(self, newData = None):
+        self.typeStats = {}     # type marker: [values, bytes, seconds]
+        self.refStats = {'string':[0, 0], 'traits':[0, 0], 'object':[0, 0]}  # [hits, misses]
+        self.records = 0
+        self.rewinds = 0
+        self.nestedBytes = 0
+        self.nestedTime = 0.0
+        amf3reader.__init__(self, newData)
+
+    def makeDecoders(self):
+        decoders = amf3reader.makeDecoders(self)
+        return [partial(self.countDecode, encoding, decoder)
+                for encoding, decoder in enumerate(decoders)]
+
+    def countDecode(self, encoding, decoder):
+        """ runs a decoder, adding what it took less its nested values to typeStats """
+        outerBytes, outerTime = self.nestedBytes, self.nestedTime
+        self.nestedBytes, self.nestedTime = 0, 0.0
+        start = self.pos
+        startTime = default_timer()
+        try:
+            return decoder()
+        finally:
+            elapsed = default_timer() - startTime
+            used = self.pos - start + 1     # and the marker
+            stats = self.typeStats.get(encoding)
+            if stats is None:
+                stats = self.typeStats[encoding] = [0, 0, 0.0]
+            stats[0] += 1
+            stats[1] += used - self.nestedBytes
+            stats[2] += elapsed - self.nestedTime
+            self.nestedBytes, self.nestedTime = outerBytes + used, outerTime + elapsed
+
+    def readRecord(self):
+        # a record starts at the top level
+        self.nestedBytes, self.nestedTime = 0, 0.0
+        record = amf3reader.readRecord(self)
+        if record is not None and record is not kSkipped:
+            self.records += 1
+        return record
+
+    def rewind(self, recordPos, traitsLen, stringCount):
+        self.rewinds += 1
+        amf3reader.rewind(self, recordPos, traitsLen, stringCount)
+
+    def scanRecord(self):
+        complete = amf3reader.scanRecord(self)
+        if not complete:
+            self.rewinds += 1
+        return complete
+
+    def readAmfString(self, stringWithoutMarker, noCache=False):
+        ref = self.peekUint29()
+        if ref != 1:    # the empty string is never a reference
+            self.refStats['string'][ref & 1] += 1
+        return amf3reader.readAmfString(self, stringWithoutMarker, noCache)
+
+    def getObject(self, index):
+        self.refStats['object'][0] += 1
+        return amf3reader.getObject(self, index)
+
+    def addObject(self, obj):
+        self.refStats['object'][1] += 1
+        amf3reader.addObject(self, obj)
+
+    def decodeObject(self):
+        ref = self.peekUint29()
+        if ref & 1:
+            self.refStats['traits'][(ref & 3) != 1] += 1
+        return amf3reader.decodeObject(self)
+
+    def peekUint29(self):
+        pos = self.pos
+        try:
+            return self.readUint29()
+        finally:
+            self.pos = pos
+
+    def getTypeName(self, encoding):
+        for name in dir(amf3reader):
+            if name.endswith('Type') and getattr(amf3reader, name) == encoding:
+                return re.sub('(Atom)?Type$', '', name[1:])
+        return "Invalid %d" % encoding
+
+    def printStats(self, out=sys.stdout):
+        print >> out, "Records = %d, Rewinds = %d" % (self.records, self.rewinds)
+        print >> out, "%-24s %10s %12s %10s" % ("type", "values", "bytes", "ms")
+        for encoding, stats in sorted(self.typeStats.items(), key=lambda item: -item[1][2]):
+            print >> out, "%-24s %10d %12d %10.1f" % (self.getTypeName(encoding),
+                stats[0], stats[1], stats[2]*1000)
+        print >> out, "%-24s %10s %12s" % ("references", "hits", "misses")
+        for kind in ('string', 'traits', 'object'):
+            hits, misses = self.refStats[kind]
+            print >> out, "%-24s %10d %12d" % (kind, hits, misses)
+
 
 
 
 if __name__ == '__main__':
     import sys
     from pprint import pprint
+    from optparse import OptionParser
 
-    if len(sys.argv) == 1:
-        print 'Usage: %s filename [filename]...' % sys.argv[0]
+    parser = OptionParser(usage="usage: %prog [options] filename [filename]...")
+    parser.add_option("-j", "--json",
+        action="store_true", dest="json", default=False,
+        help="write each metric as one line of JSON (NDJSON) as it is decoded")
+    parser.add_option("", "--fast",
+        action="store_true", dest="fast", default=False,
+        help="with --json, serialize with ujson if it is installed")
+    parser.add_option("", "--stats",
+        action="store_true", dest="stats", default=False,
+        help="print decode counts and times by type to stderr")
+    (options, args) = parser.parse_args()
+
+    if len(args) == 0:
+        print 'Usage: %s [options] filename [filename]...' % sys.argv[0]
         print 'Where filename is a .flm file'
         print 'eg. %s myfile' % sys.argv[0]
-    for filename in sys.argv[1:]:
+    for filename in args:
         file = open(filename, 'rb')
-        reader = amf3reader(file.read());
+        reader = None
+        if options.stats:
+            reader = amf3profiler()
+        if options.json:
+            export_json(file, sys.stdout, options.fast, reader)
+        else:
+            for metric in iter_metrics(file, reader=reader):
+                pprint(metric) # print each metric to stdout in JSON format
         file.close()
-        output = reader.unpack()
-        pprint(output) # print the array to stdout in JSON format
+        if options.stats:
+            print >> sys.stderr, "\nDecode stats for:", filename
+            reader.printStats(sys.stderr)
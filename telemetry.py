@@ -16,19 +16,84 @@
 # limitations under the License.
 
 import sys
+import os
+import marshal
+import hashlib
+from array import array
+from itertools import izip, chain
+from math import ceil
 from datetime import datetime, timedelta
-from time import gmtime, strftime, ctime
-from operator import itemgetter
+from time import gmtime, strftime, ctime, sleep, clock
+from time import time as wallTime
+from collections import deque
+from timeit import default_timer
+from operator import itemgetter, sub
 import locale
 locale.setlocale(locale.LC_ALL,'')
 from optparse import OptionParser
 import bisect
+import heapq
 
 import amf3reader
+try:
+    import resource
+except ImportError:
+    resource = None     # no peak memory for --profile
 
 
 kSwfFrameMarker = '.swf.frame'
 
+# metric names are handled as amf3reader symbol ids
+symbols = amf3reader.symbols
+kProfEnterTime = symbols.intern(".prof.enter.time")
+kProfEnterName = symbols.intern(".prof.enter.name")
+kProfExitTime = symbols.intern(".prof.exit.time")
+kSwfName = symbols.intern(".swf.name")
+kSwfRate = symbols.intern(".swf.rate")
+kSwfStart = symbols.intern(".swf.start")
+kTlmVersion = symbols.intern(".tlm.version")
+kTlmDate = symbols.intern(".tlm.date")
+kTlmInactive = symbols.intern(".tlm.inactive")
+kTlmActive = symbols.intern(".tlm.active")
+kCapabilities = symbols.intern(".capabilities")
+kEnter = symbols.intern(".enter")
+
+# metrics every report needs, always decoded when --only is given
+kReportNames = ['.swf.name', '.swf.rate', '.swf.start', '.tlm.version', '.tlm.date',
+                '.tlm.inactive', '.tlm.active', '.capabilities', '.rend.screen']
+
+# decoded sessions saved by --cache
+kCacheVersion = 1
+kCacheSuffix = ".tlc"
+kSessionInfo = ['name', 'rate', 'startTime', 'telemetryVersion', 'infoCount', 'inactiveTest',
+                'activeTest', 'capabilities', 'totalSpan', 'metricCount', 'time', 'lastSpanTime']
+kSpanEntry, kValueEntry, kOtherEntry = range(3)  # kinds of timeline entry
+
+# flattened entries are written to the timeline columns once this many are
+# open, keeping the latest open for the spans that enclose them
+kOpenSpansLimit = 4096
+kOpenSpansKept = 1024
+# with --follow, categories shown in each report and seconds to wait at the end of the file
+kFollowCategories = 5
+kFollowSleep = 0.25
+
+# frames listed either side of each --worst frame
+kWorstNeighbours = 2
+
+# phases of the pipeline --profile times, in the order they are listed
+kPhases = ['read', 'decode', 'addMetric', 'index', 'report', 'output']
+
+# sessions listed under each worst of the --jobs fleet summary
+kFleetWorst = 10
+
+# with --stream, timeline entries are added to the summary and dropped once
+# twice this many are held, keeping this many for spans that reach back
+kStreamKept = 65536
+
+# with --stream, the distinct frame times counted before they are put in
+# buckets ten times wider (10us, then 100us...), keeping their count bounded
+kStreamIntervals = 4096
+
 def timeStr(time):
     if time is not None:
         delta = timedelta(microseconds=time)
@@ -98,11 +163,11 @@ class Reporter():
             if self.startTime == 0:
                self.startTime = time
             self.endTime = time
-            category = getCategory(name)
+            category = getCategoryById(metric['id'])
             self.categories.addTo(category, span)
             self.metrics.addTo(name, span)
             self.span += span
-       elif options.showMemory and getCategory(name)=='Memory':
+       elif options.showMemory and getCategoryById(metric['id'])=='Memory':
             value = metric['value']
             #print 'memory', name, value
             self.memMax.addMax(name, value)
@@ -111,6 +176,52 @@ class Reporter():
             #self.memory[name] = value
             
     
+    def addRange(self, spanIndex, start, stop):
+        """ adds the timeline entries start:stop from the prefix sums of spanIndex """
+        if start >= stop:
+            return
+        startTime, endTime = spanIndex.getTimes(start, stop)
+        if self.startTime == 0:
+            self.startTime = startTime
+        if spanIndex.lastSpan[stop] >= start:
+            self.endTime = endTime
+        self.span += spanIndex.getSpan(start, stop)
+        # added in order of first use, as addSpan does, so equal totals sort the same
+        for first, category, span in sorted(spanIndex.getTotals(spanIndex.categorySums, start, stop)):
+            self.categories.addTo(category, span)
+        if options.metrics:
+            if stop - start < len(spanIndex.metricSums):
+                # fewer entries than names, adding them up is quicker
+                timeLine = spanIndex.timeLine
+                for pos in xrange(start, stop):
+                    if timeLine.kinds[pos] == kSpanEntry:
+                        self.metrics.addTo(symbols.getName(timeLine.ids[pos]), timeLine.getSpan(pos))
+            else:
+                for first, nameId, span in sorted(spanIndex.getTotals(spanIndex.metricSums, start, stop)):
+                    self.metrics.addTo(symbols.getName(nameId), span)
+        if options.showMemory:
+            positions = spanIndex.memoryPositions
+            for i in xrange(bisect.bisect_left(positions, start), bisect.bisect_left(positions, stop)):
+                self.addSpan(spanIndex.timeLine[positions[i]])
+
+    def addEntries(self, timeLine, start, stop):
+        """ adds timeLine[start:stop] entry by entry, as addRange would add them """
+        spans = timeLine.spans
+        for pos in xrange(start, stop):
+            nameId = timeLine.ids[pos]
+            if timeLine.kinds[pos] == kSpanEntry:
+                span = spans[pos]
+                time = timeLine.getTime(pos)
+                if self.startTime == 0:
+                    self.startTime = time
+                self.endTime = time
+                self.categories.addTo(getCategoryById(nameId), span)
+                if options.metrics:
+                    self.metrics.addTo(symbols.getName(nameId), span)
+                self.span += span
+            elif options.showMemory and getCategoryById(nameId) == 'Memory':
+                self.addSpan(timeLine[pos])
+
     def percentSpan(self,value):
         if value:
             return int(round(100/(self.span/value)))
@@ -152,20 +263,44 @@ class Reporter():
         #        print a[0],":",locale.format("%d", a[1], grouping=True), str(percent)+"%"              
    
 
+#limit categories until we get a more consistent naming convention in place
+kCategories = {
+    'as':"ActionScript",
+    'rend':"Rendering",
+    'network':"Network",
+    'mem':"Memory",
+    'tlm':"Telemetry"
+}
+
 def getCategory(name):
     """ extracts category from a metric name""" 
     category =  name.split('.',2)[1] # strip the first field category
-    #limit categories until we get a more consistent naming convention in place
-    categories = {
-        'as':"ActionScript",
-        'rend':"Rendering",
-        'network':"Network",
-        'mem':"Memory",
-        'tlm':"Telemetry"
-    }
-    category = categories.get(category,"Player")
+    category = kCategories.get(category,"Player")
     return category   
 
+categoryIds = []  # category of each symbol id, filled in as ids are looked up
+
+def getCategoryById(nameId):
+    """ category for a metric name id, only worked out once per name """
+    if nameId < len(categoryIds):
+        category = categoryIds[nameId]
+        if category is not None:
+            return category
+    else:
+        categoryIds.extend([None] * (nameId + 1 - len(categoryIds)))
+    category = categoryIds[nameId] = getCategory(symbols.getName(nameId))
+    return category
+
+# percentiles of frame and render times shown in the summary
+kPercentiles = [('p50', 50), ('p90', 90), ('p99', 99), ('p99.9', 99.9)]
+
+def getPercentile(values, percent):
+    """ nearest rank percentile of sorted values """
+    if not values:
+        return 0
+    rank = int(ceil(percent * len(values) / 100.0))
+    return values[min(max(rank, 1), len(values)) - 1]
+
 def deltafunction(a,b):
     if a and b:
         return b-a
@@ -182,11 +317,13 @@ class IndexList(list):
     """
     def __init__(self,marker):
         self.marker = marker
+        self.markerId = symbols.intern(marker)
         self.positions = []
         #self.deltas = []  
         self.startTime = 0
         self.endTime = 0
         self.foundMarker = False
+        self.intervals = None   # cached by getIntervals
         #self.min = 0
         #self.max = 0 
         # set false when data is pre-processed 
@@ -226,8 +363,8 @@ class IndexList(list):
             return self.endTime-self[-1]
         return self[index]-self[index-1]
          
-    def addFrame(self, name, pos, time):
-        if name == self.marker:
+    def addFrame(self, nameId, pos, time):
+        if nameId == self.markerId:
             self.append(time)
             #print "adding marker",name,time
             self.positions.append(pos)
@@ -235,7 +372,7 @@ class IndexList(list):
             self.startTime = time
         self.endTime = time
             
-    def addOldFrame(self, name, pos, time):  
+    def addOldFrame(self, nameId, pos, time):  
         # this is a little funky
         # we measure frames from one .enter to another
         # this could be made more accurate, but I'm trying replicate what is done in flashMonitor here.
@@ -243,9 +380,9 @@ class IndexList(list):
         # the reason for this is to ensure that we account correctly for nested metrics
         if self.startTime == 0:
             self.startTime = time
-        if name == self.marker:
+        if nameId == self.markerId:
             self.foundMarker = True  # remember that we found the marker, but don't add until .enter
-        if name == '.enter':
+        if nameId == kEnter:
             if self.foundMarker:    
                 self.append(self.startTime)
                 self.positions.append(pos)
@@ -281,18 +418,350 @@ class IndexList(list):
             return (float(lower + upper)) / 2         
     """
             
+    def getIntervals(self):
+        """ the times between markers, as an array worked out once for each length """
+        if self.intervals is None or len(self.intervals) != max(len(self) - 1, 0):
+            times = list(self)
+            self.intervals = array('d', map(sub, times[1:], times[:-1]))
+        return self.intervals
+
     def meanstdv(self):
         from math import sqrt
         n, mean, std = len(self), 0.0, 0.0
         if n >0:
-            for i in range(len(self)):
-                mean = mean + self.getInterval(i)
+            intervals = self.getIntervals()
+            mean = sum(chain([self.getInterval(0)], intervals))
             mean = mean / float(n)
-            for i in range(1,len(self)):
-                std = std + (self.getInterval(i) - mean)**2
+            std = sum([(interval - mean)**2 for interval in intervals])
             std = sqrt(std / float(n))
         return mean, std  
+
+    def getStats(self, budget=0):
+        """
+        distribution of the times between markers: percentiles, max, and the
+        number over budget and over twice budget (if budget is given)
+        """
+        values = sorted(self.getIntervals())
+        stats = {'count':len(values), 'over':0, 'over2':0}
+        for name, percent in kPercentiles:
+            stats[name] = getPercentile(values, percent)
+        stats['max'] = values[-1] if values else 0
+        if budget and values:
+            stats['over'] = len(values) - bisect.bisect_right(values, budget)
+            stats['over2'] = len(values) - bisect.bisect_right(values, 2*budget)
+        return stats
+
+    def printStats(self, label, budget=0):
+        printStats(label, self.getStats(budget), budget)
+
+
+class StreamIndexList(object):
+    """
+    IndexList for --stream: counts the markers and how often each time between
+    them was seen instead of keeping every marker. Past kStreamIntervals
+    distinct times they are counted in buckets, so the size is bounded and the
+    percentiles and over budget counts then go by the middle of each bucket.
+    """
+    def __init__(self, marker):
+        self.marker = marker
+        self.markerId = symbols.intern(marker)
+        self.count = 0
+        self.startTime = 0
+        self.lastTime = 0       # time of the last marker
+        self.total = 0          # time to the first marker then between markers, summed in order
+        self.intervals = {}     # number of intervals seen, by the start of their bucket
+        self.width = 1          # bucket width in us, 1 until there are too many distinct intervals
+        self.maxInterval = 0
+        self.recent = None      # with --follow, a deque of the latest marker times
+
+    def __len__(self):
+        return self.count
+
+    def addFrame(self, nameId, pos, time):
+        if self.startTime == 0:
+            self.startTime = time
+        if nameId == self.markerId:
+            if self.recent is not None:
+                self.recent.append(time)
+            if self.count:
+                interval = time - self.lastTime
+                self.total += interval
+                self.maxInterval = max(self.maxInterval, interval)
+                if self.width > 1:
+                    interval -= interval % self.width
+                self.intervals[interval] = self.intervals.get(interval, 0) + 1
+                if len(self.intervals) > kStreamIntervals:
+                    self.widen()
+            else:
+                self.total += time - self.startTime
+            self.lastTime = time
+            self.count += 1
+
+    def widen(self):
+        """ makes the buckets ten times wider until there are few enough """
+        while len(self.intervals) > kStreamIntervals:
+            self.width *= 10
+            intervals = {}
+            for interval, n in self.intervals.iteritems():
+                interval -= interval % self.width
+                intervals[interval] = intervals.get(interval, 0) + n
+            self.intervals = intervals
+
+    def meanstdv(self):
+        """ the mean as IndexList gives it, the deviation is not kept """
+        mean = 0.0
+        if self.count:
+            mean = self.total / float(self.count)
+        return mean, 0.0
+
+    def getStats(self, budget=0):
+        count = self.count and self.count - 1
+        stats = {'count':count, 'over':0, 'over2':0}
+        middle = self.width / 2
+        values = sorted((interval + middle, n) for interval, n in self.intervals.iteritems())
+        ranks = []
+        rank = 0
+        for interval, n in values:
+            rank += n
+            ranks.append(rank)
+        for name, percent in kPercentiles:
+            stats[name] = 0
+            if count:
+                rank = min(max(int(ceil(percent * count / 100.0)), 1), count)
+                stats[name] = values[bisect.bisect_left(ranks, rank)][0]
+        stats['max'] = self.maxInterval
+        if budget:
+            for interval, n in values:
+                if interval > budget:
+                    stats['over'] += n
+                if interval > 2*budget:
+                    stats['over2'] += n
+        return stats
+
+    def printStats(self, label, budget=0):
+        printStats(label, self.getStats(budget), budget)
+
+def printStats(label, stats, budget=0):
+    """ prints the stats of an index list in ms, with the frames over budget if it is given """
+    if not stats['count']:
+        return
+    print "%s Time %s, max = %.2f ms" % (label,
+        ", ".join("%s = %.2f" % (name, stats[name]/1000.0) for name, percent in kPercentiles),
+        stats['max']/1000.0)
+    if budget:
+        print "%ss over budget (%.2f ms) = %d (%.2f%%), over 2x = %d" % (label, budget/1000.0,
+            stats['over'], 100.0*stats['over']/stats['count'], stats['over2'])
    
+class TimeLine(object):
+    """
+    The flattened metrics of a session held as parallel columns rather than a
+    dict per entry: times and spans as doubles, name ids and depths as ints,
+    the kind of each entry, and the values of value entries in a side table.
+    Entries are added and read back as dicts, or read column by column.
+    """
+
+    def __init__(self):
+        self.times = array('d')
+        self.spans = array('d')     # 0 for entries without a span
+        self.ids = array('i')
+        self.depths = array('i')
+        self.kinds = array('B')     # kSpanEntry, kValueEntry or kOtherEntry
+        self.valuePositions = array('I')
+        self.values = []
+        # read times and spans back as ints while only ints were added
+        self.intTimes = True
+        self.intSpans = True
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def append(self, m):
+        time = m['time']
+        if type(time) != int:
+            self.intTimes = False
+        self.times.append(time)
+        self.ids.append(m['id'])
+        self.depths.append(m['depth'])
+        span = m.get('span')
+        if span is not None:
+            if type(span) != int:
+                self.intSpans = False
+            self.spans.append(span)
+            self.kinds.append(kSpanEntry)
+            return
+        self.spans.append(0)
+        if m.has_key('value'):
+            self.kinds.append(kValueEntry)
+            self.valuePositions.append(len(self.kinds) - 1)
+            self.values.append(m['value'])
+        else:
+            self.kinds.append(kOtherEntry)
+
+    def pop(self):
+        """ removes the last entry and returns it as a dict """
+        m = self[len(self.kinds) - 1]
+        for column in (self.times, self.spans, self.ids, self.depths, self.kinds):
+            column.pop()
+        if m.has_key('value'):
+            self.valuePositions.pop()
+            self.values.pop()
+        return m
+
+    def getTime(self, pos):
+        time = self.times[pos]
+        if self.intTimes:
+            return int(time)
+        return time
+
+    def getSpan(self, pos):
+        span = self.spans[pos]
+        if self.intSpans:
+            return int(span)
+        return span
+
+    def getValue(self, pos):
+        return self.values[bisect.bisect_left(self.valuePositions, pos)]
+
+    def __getitem__(self, pos):
+        if isinstance(pos, slice):
+            return [self[i] for i in xrange(*pos.indices(len(self.kinds)))]
+        if pos < 0:
+            pos += len(self.kinds)
+        nameId = self.ids[pos]
+        m = {'time':self.getTime(pos), 'name':symbols.getName(nameId), 'id':nameId,
+             'depth':self.depths[pos]}
+        kind = self.kinds[pos]
+        if kind == kSpanEntry:
+            m['span'] = self.getSpan(pos)
+        elif kind == kValueEntry:
+            m['value'] = self.getValue(pos)
+        return m
+
+    def __iter__(self):
+        for pos in xrange(len(self.kinds)):
+            yield self[pos]
+
+    def drop(self, count):
+        """ removes the first count entries """
+        for column in (self.times, self.spans, self.ids, self.depths, self.kinds):
+            del column[:count]
+        i = bisect.bisect_left(self.valuePositions, count)
+        del self.values[:i]
+        self.valuePositions = array('I', [pos - count for pos in self.valuePositions[i:]])
+
+
+class SpanIndex(object):
+    """
+    Running totals over a flattened timeline, so the time in any range of it
+    is the difference of two prefix values. spanSums holds the span total
+    before each position. categorySums and metricSums hold the span entries of
+    each category and name id as (positions, totals before each of them), so
+    their totals in a range take a bisect on each side.
+    """
+
+    def __init__(self, timeLine):
+        self.timeLine = timeLine
+        n = len(timeLine)
+        self.spanSums = array('d', [0.0]) * (n + 1)
+        self.categorySums = {}
+        self.metricSums = {}
+        self.memoryPositions = array('I')
+        self.firstStart = array('l', [n]) * (n + 1)  # first span entry at or after each position with a time
+        self.lastSpan = array('l', [-1]) * (n + 1)  # last span entry before each position
+        categorySums = self.categorySums
+        metricSums = self.metricSums
+        total = 0
+        last = -1
+        pos = 0
+        for nameId, kind, span in izip(timeLine.ids, timeLine.kinds, timeLine.spans):
+            if kind == kSpanEntry:
+                total += span
+                last = pos
+                for sums, key in ((categorySums, getCategoryById(nameId)), (metricSums, nameId)):
+                    entry = sums.get(key)
+                    if entry is None:
+                        entry = sums[key] = (array('I'), array('d', [0.0]))
+                    entry[0].append(pos)
+                    entry[1].append(entry[1][-1] + span)
+            elif getCategoryById(nameId) == 'Memory':
+                self.memoryPositions.append(pos)
+            pos += 1
+            self.spanSums[pos] = total
+            self.lastSpan[pos] = last
+        first = n
+        times = timeLine.times
+        kinds = timeLine.kinds
+        for pos in xrange(n - 1, -1, -1):
+            if kinds[pos] == kSpanEntry and times[pos] != 0:
+                first = pos
+            self.firstStart[pos] = first
+
+    def getRange(self, pos, pos2):
+        """ start, stop of timeLine[pos:pos2], as slicing gives them """
+        start, stop, step = slice(pos, pos2).indices(len(self.timeLine))
+        return start, max(start, stop)
+
+    def getSpan(self, start, stop):
+        """ span time of the entries start:stop """
+        return self.spanSums[stop] - self.spanSums[start]
+
+    def getTimes(self, start, stop):
+        """ (start time, end time) of the span entries start:stop, as Reporter finds them """
+        startTime = endTime = 0
+        if start < stop:
+            first = self.firstStart[start]
+            if first < stop:
+                startTime = self.timeLine.getTime(first)
+            last = self.lastSpan[stop]
+            if last >= start:
+                endTime = self.timeLine.getTime(last)
+        return startTime, endTime
+
+    def getTotals(self, sums, start, stop):
+        """ [(first position, key, span)] for the keys of sums with span entries in start:stop """
+        totals = []
+        for key, (positions, spans) in sums.iteritems():
+            i = bisect.bisect_left(positions, start)
+            if i < len(positions) and positions[i] < stop:
+                j = bisect.bisect_left(positions, stop, i)
+                totals.append((positions[i], key, spans[j] - spans[i]))
+        return totals
+
+
+class OpenSpan(object):
+    """
+    A flattened span metric with children, held by swfInstance.flatten until
+    flushTimeLine. items are its fragments (depth -1) then its child entries
+    and OpenSpans, in timeline order. A span containing it takes it whole.
+    """
+    __slots__ = ('items', 'minTime', 'lastTime', 'firstStart', 'lastEnd', 'spanSum')
+
+    def __init__(self):
+        self.items = []
+        self.minTime = 0        # earliest time of any of its entries
+        self.lastTime = 0       # time of its last entry
+        self.firstStart = None  # time of its first span entry
+        self.lastEnd = 0        # end of its last span entry
+        self.spanSum = 0        # total span of its entries
+
+    def getEntries(self, timeLine=None):
+        """ appends its entries to timeLine at their final depths, one level below the caller """
+        if timeLine is None:
+            timeLine = []
+        stack = [(iter(self.items), 1)]
+        while stack:
+            items, depth = stack[-1]
+            for item in items:
+                if type(item) == dict:
+                    item['depth'] += depth
+                    timeLine.append(item)
+                else:
+                    stack.append((iter(item.items), depth+1))
+                    break
+            else:
+                stack.pop()
+        return timeLine
+
 class swfInstance():
     def __init__(self):
         self.reset()
@@ -305,10 +774,19 @@ class swfInstance():
         self.date = gmtime();
         self.infoCount = 0
         #self.dataList = []
-        self.timeLine = []
+        self.timeLine = TimeLine()
+        self.openSpans = []  # flattened entries and OpenSpans not yet in timeLine
+        self.entryCount = 0  # length of timeLine once openSpans are added
         # index by enterframe and render events so we can report both FPS rates
         self.indexList = IndexList(options.frameMarker)
         self.renderList = IndexList(".rend.screen")
+        self.summary = None  # with --stream, the Reporter dropped entries were added to
+        self.dropped = 0     # number of entries dropped from the start of timeLine
+        self.droppedTime = 0 # time of the last of them
+        if options.stream:
+            self.indexList = StreamIndexList(options.frameMarker)
+            self.renderList = StreamIndexList(".rend.screen")
+            self.summary = Reporter()
         self.time = 0
         self.frameMarker = kSwfFrameMarker
         self.totalSpan = 0  # total span time recorded (before subtracting nested time)
@@ -319,10 +797,22 @@ class swfInstance():
         self.metricCount = 0
         self.profstack = []
         self.capabilities = {}
+        self.frameBase = 0   # frame number of index 0 when only a range was decoded
+        self.reported = None # (metric count, index list, render list, reporter) of the summary printed
         
     def haveInfo(self):  # got what we need already    
         return self.infoCount > 4; 
 
+    def copyInfo(self, other):
+        """ takes the header info read by another instance """
+        self.name = other.name
+        self.rate = other.rate
+        self.startTime = other.startTime
+        self.telemetryVersion = other.telemetryVersion
+        self.date = other.date
+        self.capabilities = other.capabilities
+        self.infoCount = other.infoCount
+
     def swfInfo(self):  # got what we need already 
         return {
             'name':self.name,
@@ -379,58 +869,61 @@ class swfInstance():
             metric["time"] = self.time
             
         name = metric['name']
+        nameId = metric.get('id')
+        if nameId is None:
+            nameId = metric['id'] = symbols.intern(name)
         
-        if name.startswith(".prof."):
-           if name==".prof.enter.time":
-                m = {'name':"none",'time':self.time,'span':0}
-                #print "profstack push", m
-                self.profstack.append(m)
-                return
-           elif name==".prof.enter.name":
-                self.profstack[-1]["name"] = ".as."+metric['value']
+        if nameId==kProfEnterTime:
+            m = {'name':"none",'time':self.time,'span':0}
+            #print "profstack push", m
+            self.profstack.append(m)
+            return
+        elif nameId==kProfEnterName:
+            self.profstack[-1]["name"] = ".as."+metric['value']
+            return
+        elif nameId==kProfExitTime:
+            if len(self.profstack) < 1: 
+                print "profstack empty error", metric
                 return
-           elif name==".prof.exit.time":
-                if len(self.profstack) < 1: 
-                    print "profstack empty error", metric
-                    return
-                metric = self.profstack.pop()
-                metric["span"] = self.time - metric["time"]
-                metric["time"] = self.time
-                if metric["span"] < 0:
-                    print("profstack invalid pop ",metric)
+            metric = self.profstack.pop()
+            metric["span"] = self.time - metric["time"]
+            metric["time"] = self.time
+            metric["id"] = symbols.intern(metric["name"])
+            if metric["span"] < 0:
+                print("profstack invalid pop ",metric)
              
         #self.printMetric(metric);
         
-        self.flatten(metric,self.timeLine)
+        self.flatten(metric)
+        if len(self.openSpans) > kOpenSpansLimit:
+            self.flushTimeLine(kOpenSpansKept)
 
         #self.dataList.append(metric)
         
         if self.haveInfo():
             return; 
             
-        if name.startswith(".swf."):
-            if name==".swf.name":
-                self.name = metric['value']
-                self.infoCount += 1
-            elif name==".swf.rate":
-                self.rate = metric['value']
-                self.infoCount += 1
-            elif name==".swf.start":
-                self.startTime = metric['time']
-                self.time = self.startTime
-                self.infoCount += 1
-        elif name.startswith(".tlm."):
-            if name == ".tlm.version":
-                self.telemetryVersion = metric['value']
-                self.infoCount += 1
-            elif name==".tlm.date":
-                self.date = datetime.fromtimestamp(metric['value']/1000);
-                self.infoCount += 1
-            elif name==".tlm.inactive":
-                self.inactiveTest = metric['span']
-            elif name==".tlm.active":
-                self.activeTest = metric['span'] 
-        elif name==".capabilities":
+        if nameId==kSwfName:
+            self.name = metric['value']
+            self.infoCount += 1
+        elif nameId==kSwfRate:
+            self.rate = metric['value']
+            self.infoCount += 1
+        elif nameId==kSwfStart:
+            self.startTime = metric['time']
+            self.time = self.startTime
+            self.infoCount += 1
+        elif nameId == kTlmVersion:
+            self.telemetryVersion = metric['value']
+            self.infoCount += 1
+        elif nameId==kTlmDate:
+            self.date = datetime.fromtimestamp(metric['value']/1000);
+            self.infoCount += 1
+        elif nameId==kTlmInactive:
+            self.inactiveTest = metric['span']
+        elif nameId==kTlmActive:
+            self.activeTest = metric['span'] 
+        elif nameId==kCapabilities:
             from urlparse import urlparse
             from urllib2 import unquote
             url = urlparse("http://foo.bar?"+unquote(metric['value']))
@@ -439,13 +932,18 @@ class swfInstance():
             #self.capabilities = dict([part.split('=') for part in url.split('&')]) 
             print "capabilities",self.capabilities 
 
-    def flatten(self, metric, timeLine):
+    def flatten(self, metric):
         """ creates a flat list by inserting fragments for nested logic
             all times are normalized to start time+span
             this provides accurate measurment of metric and category time wihtin any arbitray time span
+            Entries are held in self.openSpans until flushTimeLine moves them to timeLine,
+            so a span takes its children as a whole rather than re-adding each of them.
+            A span reaching back past them takes its children back out of timeLine
         """
         #print "flattening", metric
         name = metric['name']
+        nameId = metric['id']
+        openSpans = self.openSpans
         if metric.has_key("span"):
             span = metric['span']
             end =  metric['time']
@@ -453,61 +951,130 @@ class swfInstance():
                 print "Invalid Metric span"
             #print "flatten metric", metric
             start = end-span
-            self.indexList.addFrame(name, len(timeLine), start)
-            self.renderList.addFrame(name, len(timeLine), start)
+            self.indexList.addFrame(nameId, self.entryCount, start)
+            self.renderList.addFrame(nameId, self.entryCount, start)
             self.totalSpan += span  # track this for sanity check
-            childSpanSum = 0
-            # find all children of this span 
-            childIndex = -1
-            i = len(timeLine) - 1
-            while i >=0:
-                if timeLine[i].has_key('time'):
-                    if timeLine[i]['time'] >= start:
-                        childIndex = i
-                    else:
+            # find all children of this span, the trailing entries from start on
+            childIndex = len(openSpans)
+            while childIndex > 0:
+                entry = openSpans[childIndex-1]
+                if type(entry) == dict:
+                    if entry['time'] < start:
                         break
-                i -= 1
-                
-            if childIndex > -1:
-                # remove children from the list
-                children = timeLine[childIndex:]
-                timeLine[childIndex:] = []
-                
-                # add children back in, inserting fragmented spans as needed
-                for child in children:
-                    if child.has_key('span'):
-                        childStart = child['time']
-                        childSpan = child['span']
-                        childSpanSum += childSpan
-                        if childStart > start:  # insert fractional metric for extra space
-                            newChildSpan = childStart-start
-                            newChild = {'time':start,'span':newChildSpan,'name':name,'depth':0}
-                            #if not primarySpan: newChild['secondary'] = True  #mark secondary (fragment) references
-                            #print "newChild added", newChild
-                            timeLine.append(newChild)
-                            span -= newChildSpan
-                        #print "child Added",child
-                        child['depth'] += 1
-                        timeLine.append(child)
-                        span -= childSpan
-                        start = childStart+childSpan
-                    else:
-                        child['depth'] += 1
-                        timeLine.append(child)  
-                        
+                elif entry.minTime < start:
+                    if entry.lastTime < start:
+                        break
+                    # only its last entries are children, take them one by one
+                    entries = entry.getEntries()
+                    openSpans[childIndex-1:childIndex] = entries
+                    childIndex += len(entries) - 1
+                    continue
+                childIndex -= 1
+            if childIndex == 0:
+                # reaching back past the open entries, take the last entries written out
+                timeLine = self.timeLine
+                entries = []
+                while len(timeLine) and timeLine.getTime(len(timeLine)-1) >= start:
+                    entries.append(timeLine.pop())
+                if not len(timeLine) and self.dropped and self.droppedTime >= start:
+                    print "Span reaches back past the streamed metrics", name
+                entries.reverse()
+                openSpans[0:0] = entries
+            if childIndex == len(openSpans):
+                openSpans.append({'time':start,'span':span,'name':name,'id':nameId,'depth':0})
+                self.entryCount += 1
+                return
+            children = openSpans[childIndex:]
+            del openSpans[childIndex:]
+
+            node = OpenSpan()
+            items = node.items
+            childSpanSum = 0
+            for child in children:
+                if type(child) == dict:
+                    if not child.has_key('span'):
+                        items.append(child)
+                        continue
+                    childStart = child['time']
+                    childSpan = child['span']
+                    childEnd = childStart+childSpan
+                else:
+                    # the entries of a span are contiguous, only its first can leave a gap
+                    childStart = child.firstStart
+                    childSpan = child.spanSum
+                    childEnd = child.lastEnd
+                childSpanSum += childSpan
+                if childStart > start:  # insert fractional metric for extra space
+                    newChildSpan = childStart-start
+                    newChild = {'time':start,'span':newChildSpan,'name':name,'id':nameId,'depth':-1}
+                    items.append(newChild)
+                    self.entryCount += 1
+                    span -= newChildSpan
+                    if node.firstStart is None:
+                        node.firstStart = start
+                if node.firstStart is None:
+                    node.firstStart = childStart
+                items.append(child)
+                span -= childSpan
+                start = childEnd
+
             if childSpanSum > metric['span']:
                 print "Invalid Child span", metric['span'], childSpanSum          
-            timeLine.append({'time':start,'span':span,'name':name,'depth':0})             
+            items.append({'time':start,'span':span,'name':name,'id':nameId,'depth':-1})
+            self.entryCount += 1
+            # children before its first span entry go ahead of it, so a span
+            # containing this one inserts a fragment after them, not before
+            first = 0
+            while type(items[first]) == dict and not items[first].has_key('span'):
+                items[first]['depth'] += 1
+                first += 1
+            if first:
+                openSpans.extend(items[:first])
+                del items[:first]
+            if len(items) == 1:
+                items[0]['depth'] = 0
+                openSpans.append(items[0])
+                return
+            if node.firstStart is None:
+                node.firstStart = start
+            node.minTime = min([item['time'] if type(item) == dict else item.minTime for item in items])
+            node.lastTime = start
+            node.lastEnd = start+span
+            node.spanSum = metric['span']
+            openSpans.append(node)
             #print "appended", {'time':start,'span':span,'name':name}
         else:
             # add non-span metrics
-            self.indexList.addFrame(name, len(timeLine), self.time)
-            self.renderList.addFrame(name, len(timeLine), self.time)
+            self.indexList.addFrame(nameId, self.entryCount, self.time)
+            self.renderList.addFrame(nameId, self.entryCount, self.time)
             m = dict(metric)
             m['depth'] = 0
-            timeLine.append(m)
+            self.entryCount += 1
+            openSpans.append(m)
+
+    def flushTimeLine(self, keep=0):
+        """ adds the entries held in openSpans to timeLine, all but the last keep """
+        count = len(self.openSpans) - keep
+        for entry in self.openSpans[:count]:
+            if type(entry) == dict:
+                self.timeLine.append(entry)
+            else:
+                entry.getEntries(self.timeLine)
+        del self.openSpans[:count]
+        if self.summary is not None and len(self.timeLine) >= 2*kStreamKept:
+            self.dropTimeLine(kStreamKept)
+
+    def dropTimeLine(self, keep=0):
+        """ adds all but the last keep entries of timeLine to summary and drops them """
+        count = len(self.timeLine) - keep
+        if count > 0:
+            self.summary.addEntries(self.timeLine, 0, count)
+            self.droppedTime = self.timeLine.getTime(count-1)
+            self.timeLine.drop(count)
+            self.dropped += count
 
     def validate(self):
+        self.flushTimeLine()
         for i in range(len(self.timeLine)):
             if not i: continue
             m = self.timeLine[i-1]
@@ -521,10 +1088,19 @@ class swfInstance():
 
     
     def process(self):
+        self.flushTimeLine()
         print "Date = " + str(self.date)   
         print self.getInfoStr();
         print "Startup Time = ", timeStr(self.startTime)
-        
+
+        if self.summary is not None:
+            # --stream, the entries left are added to the summary like the rest
+            self.dropTimeLine()
+            self.printSummary(self.dropped, self.indexList, self.renderList, self.summary)
+            print
+            return
+
+        self.spanIndex = SpanIndex(self.timeLine)
         if options.range:
             try:
                 rstart, rend = options.range.split(":")
@@ -533,15 +1109,15 @@ class swfInstance():
             except:
                 print "Invalid range %s, must be in start:end format" % options.range
                 return            
-            pos = self.indexList.getPositionByIndex(rstart)
-            pos2 = self.indexList.getPositionByIndex(rend)
-            indexList = self.indexList[rstart:rend]
-            selection = self.timeLine[pos:pos2]
-            if not len(selection): 
+            pos = self.indexList.getPositionByIndex(rstart - self.frameBase)
+            pos2 = self.indexList.getPositionByIndex(rend - self.frameBase)
+            indexList = self.indexList[rstart - self.frameBase:rend - self.frameBase]
+            start, stop = self.spanIndex.getRange(pos, pos2)
+            if start == stop: 
                 print "No metrics in Range %d:%d" % (rstart, rend)
                 return
-            t1 = selection[0].get('time',0)
-            t2 = selection[-1].get('time',0)
+            t1 = self.timeLine.getTime(start)
+            t2 = self.timeLine.getTime(stop-1)
             renderPos1 = self.renderList.getIndexByTime(t1)
             renderPos2 = self.renderList.getIndexByTime(t2)
             print "Range %d:%d (%s-%s)" % (rstart, len(indexList), timeStr(t1), timeStr(t2))
@@ -549,16 +1125,59 @@ class swfInstance():
         else:
             rstart = 0
             rend = len(self.indexList)
-            selection = self.timeLine  
+            start, stop = 0, len(self.timeLine)
             renderList = self.renderList 
             indexList = self.indexList      
         
-        print "Metric Count = %d" % len(selection)
+        #self.validate()
+        reporter = Reporter()
+        reporter.addRange(self.spanIndex, start, stop)
+        self.printSummary(stop - start, indexList, renderList, reporter)
+                 
+        if options.showFrames: 
+            for index in range(rstart,rend):
+                self.rangeReport(index, index+1)
+        if options.worst:
+            self.worstReport(rstart, rend, options.worst)
+        print                
+
+    def worstReport(self, index1, index2, count):
+        """
+        reports the count longest frames of index1:index2 in full, worst first,
+        each after a line for it and the frames either side
+        """
+        worst = []  # heap of (frame time, load, frame) of the longest found so far
+        index2 = min(index2, len(self.indexList) + self.frameBase)
+        # frame 0 is the time before the first marker, not a frame time
+        for index in xrange(max(index1, self.frameBase + 1), index2):
+            start, stop, load = self.getRangeLoad(index, index+1)
+            if options.loadFilter and load < options.loadFilter:
+                continue
+            entry = (self.indexList.getInterval(index - self.frameBase), load, index)
+            if len(worst) < count:
+                heapq.heappush(worst, entry)
+            elif entry > worst[0]:
+                heapq.heapreplace(worst, entry)
+        worst.sort(reverse=True)
+        print "\nWorst %d Frames:" % len(worst)
+        for interval, load, index in worst:
+            print "  #%d: %.2f ms, Load %.2f%%" % (index, interval/1000.0, load)
+        for interval, load, worstIndex in worst:
+            print "\nFrame #%d: %.2f ms" % (worstIndex, interval/1000.0)
+            for index in xrange(max(index1, worstIndex - kWorstNeighbours),
+                                min(index2, worstIndex + kWorstNeighbours + 1)):
+                start, stop, load = self.getRangeLoad(index, index+1)
+                print "%s #%d: %.2f ms, Load %.2f%%" % (">" if index == worstIndex else " ", index,
+                    self.indexList.getInterval(index - self.frameBase)/1000.0, load)
+            start, stop, load = self.getRangeLoad(worstIndex, worstIndex+1)
+            self.printRange(worstIndex, worstIndex+1, start, stop, load)
+
+    def printSummary(self, metricCount, indexList, renderList, reporter):
+        """ the summary report of metricCount entries added to reporter """
+        self.reported = (metricCount, indexList, renderList, reporter)
+        print "Metric Count = %d" % metricCount
         print "Frame Count = %d" % len(indexList)
         print "Render Count = %d" % len(renderList)
-   
-        #self.validate()
-        reporter = Reporter(selection);
         
         runTime = reporter.endTime-reporter.startTime
         print "Run Time = ", timeStr(runTime)
@@ -573,6 +1192,8 @@ class swfInstance():
         if average:
             #print average, len(renderList)
             print "Render RPS = %.2f" % (1000000/average)
+        indexList.printStats("Frame", self.rate)
+        renderList.printStats("Render")
         if self.inactiveTest:
             print "Telemetry Inactive Test", self.inactiveTest
         if self.activeTest:
@@ -580,34 +1201,613 @@ class swfInstance():
             
         
         reporter.report()
-                 
-        if options.showFrames: 
-            for index in range(rstart,rend):
-                self.rangeReport(index, index+1)
-        print                
 
-    def rangeReport(self, index1, index2):
-        pos = self.indexList.getPositionByIndex(index1)
-        pos2 = self.indexList.getPositionByIndex(index2)
+    def getSummary(self):
+        """ the figures of the summary process printed as plain values, None if it printed none """
+        if self.reported is None:
+            return None
+        metricCount, indexList, renderList, reporter = self.reported
+        runTime = reporter.getInterval()
+        summary = {'name':self.name, 'rate':self.rate, 'metricCount':metricCount,
+                   'frames':len(indexList), 'renders':len(renderList),
+                   'runTime':runTime, 'span':reporter.getSpan(), 'load':0, 'fps':0, 'rps':0,
+                   'frameTimes':indexList.getStats(self.rate), 'categories':dict(reporter.categories)}
+        if runTime:
+            summary['load'] = (reporter.getSpan()/runTime)*100
+        for key, index in (('fps', indexList), ('rps', renderList)):
+            average, stdev = index.meanstdv()
+            if average:
+                summary[key] = 1000000/average
+        return summary
+
+    def getRangeLoad(self, index1, index2):
+        """ (start, stop, load) of the timeline entries of frames index1:index2 """
+        pos = self.indexList.getPositionByIndex(index1 - self.frameBase)
+        pos2 = self.indexList.getPositionByIndex(index2 - self.frameBase)
         #print "RANGE", index1, index2, pos, pos2
-        frame = self.timeLine[pos:pos2]
-        reporter = Reporter(frame)
+        start, stop = self.spanIndex.getRange(pos, pos2)
+        span = self.spanIndex.getSpan(start, stop)
+        startTime, endTime = self.spanIndex.getTimes(start, stop)
         load = 0
-        if reporter.getSpan() and reporter.getInterval():
-            load = ((reporter.getSpan()/reporter.getInterval())*100)
+        if span and endTime-startTime:
+            load = ((span/(endTime-startTime))*100)
+        return start, stop, load
+
+    def rangeReport(self, index1, index2):
+        start, stop, load = self.getRangeLoad(index1, index2)
         if options.loadFilter and load < options.loadFilter: return
+        self.printRange(index1, index2, start, stop, load)
+
+    def printRange(self, index1, index2, start, stop, load):
+        reporter = Reporter()
+        reporter.addRange(self.spanIndex, start, stop)
         if index1+1 == index2:
             print "\nReport for frame #", index1  
         else:  
             print "\nReport for range %d-%d" % index1, index2   
-        frameTime =frame[0].get('time',0)
+        frameTime = 0
+        if start < stop:
+            frameTime = self.timeLine.getTime(start)
         print "Time: %s (%d/%d)"% (timeStr(frameTime),reporter.getInterval(),reporter.getSpan())
         print "Load %.2f%%" % load
 
         reporter.report()
         if options.showMetrics:
-            for m in frame:
-                self.printMetric(m)                
+            for pos in xrange(start, stop):
+                self.printMetric(self.timeLine[pos])                
+
+def parseRange(text):
+    """ returns (start, end) from start:end, None if it is not in that format """
+    try:
+        rstart, rend = text.split(":")
+        return int(rstart), int(rend)
+    except ValueError:
+        return None
+
+def getNameFilter():
+    """ the --only patterns as an amf3reader nameFilter, None to decode everything """
+    if not options.only:
+        return None
+    patterns = options.only.split(",") + kReportNames + [options.frameMarker]
+    return amf3reader.makeNameFilter(patterns)
+
+def loadIndexedRange(filename, swf, rstart, rend):
+    """
+    decodes only the frames rstart:rend into swf, seeking with the sidecar index
+    the header info is taken from the metrics before the first frame
+    """
+    index = amf3reader.openIndex(filename, options.frameMarker)
+    file = open(filename, 'rb')
+    tlm = amf3reader.amf3mappedreader(file)
+    tlm.nameIds = True
+    tlm.nameFilter = getNameFilter()
+    header = swfInstance()
+    for metric in tlm.readMetrics():
+        header.addMetric(metric)
+        if header.haveInfo() or len(header.indexList):
+            break
+    swf.copyInfo(header)
+
+    # start a couple of frames early so that spans reaching back before the range
+    # gather their children just as they do in a full decode
+    frames = len(index.frames)
+    first = 0
+    if rstart > 2 and frames > 2:
+        swf.frameBase = min(rstart, frames) - 2
+        first = index.frameRecord(swf.frameBase)
+    last = len(index)
+    if 0 <= rend < frames:
+        last = index.frameRecord(rend) + 1  # the marker that ends the range
+    if first < last:
+        tlm.seekRecord(index, first)
+        if first:
+            swf.lastSpanTime = index.clocks[index.getCheckpoint(first)]
+            swf.time = index.times[first - 1]
+        # records rejected by --only come back as kSkipped, they still count
+        for record in xrange(first, last):
+            metric = tlm.readRecord()
+            if not metric:
+                break
+            if metric is not amf3reader.kSkipped:
+                swf.addMetric(metric)
+    tlm.close()
+    file.close()
+
+def getWindowList(indexList, startTime):
+    """ an IndexList of the markers of a StreamIndexList from startTime on, for --follow """
+    recent = indexList.recent
+    while recent and recent[0] < startTime:
+        recent.popleft()
+    window = IndexList(indexList.marker)
+    window.extend(recent)
+    if len(window):
+        window.startTime = window[0]
+        window.endTime = window[-1]
+    return window
+
+def printWindow(swf, window):
+    """ the rates, load and top categories of the last window microseconds of swf """
+    swf.flushTimeLine()
+    timeLine = swf.timeLine
+    startTime = swf.time - window
+    frames = getWindowList(swf.indexList, startTime)
+    renders = getWindowList(swf.renderList, startTime)
+    reporter = Reporter()
+    reporter.addEntries(timeLine, bisect.bisect_left(timeLine.times, startTime), len(timeLine))
+    out = "%s:" % timeStr(swf.time)
+    for label, indexList in (("FPS", frames), ("Render RPS", renders)):
+        intervals = indexList.getIntervals()
+        if intervals:
+            out += " %s = %.2f," % (label, 1000000.0*len(intervals)/(indexList[-1]-indexList[0]))
+    runTime = reporter.getInterval()
+    if runTime:
+        out += " Load = %.2f%%," % ((reporter.getSpan()/runTime)*100)
+    stats = frames.getStats(swf.rate)
+    if stats['count']:
+        out += " Frame Time p99 = %.2f ms, max = %.2f ms," % (stats['p99']/1000.0, stats['max']/1000.0)
+        if swf.rate:
+            out += " over budget = %d," % stats['over']
+    print out.rstrip(",")
+    categories = ["%s %d%%" % (category, reporter.percentSpan(span))
+                  for category, span in reporter.categories.getSorted()[:kFollowCategories]
+                  if reporter.percentSpan(span) > 0]
+    if categories:
+        print "  " + ", ".join(categories)
+    sys.stdout.flush()
+
+def followCapture(filename, swf):
+    """
+    tails filename as it is written, decoding only the data added since the last
+    read, and prints the stats of the last --window seconds every --interval seconds
+    ^C stops and gives the summary of what was read
+    """
+    file = open(filename, 'rb')
+    tlm = amf3reader.amf3reader()
+    tlm.nameIds = True
+    tlm.nameFilter = getNameFilter()
+    swf.indexList.recent = deque()
+    swf.renderList.recent = deque()
+    window = int(options.window * 1000000)
+    nextReport = wallTime() + options.interval
+    lastTime = None
+    try:
+        while True:
+            data = file.read(amf3reader.kChunkSize)
+            if data:
+                for metric in tlm.feed(data):
+                    swf.addMetric(metric)
+            else:
+                sleep(kFollowSleep)
+            if wallTime() >= nextReport:
+                nextReport += options.interval
+                if swf.time != lastTime:  # nothing new, nothing to say
+                    lastTime = swf.time
+                    printWindow(swf, window)
+    except KeyboardInterrupt:
+        print
+    file.close()
+
+def getPeakMemory():
+    """ peak resident memory of the process in kB, 0 where it can't be found """
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024    # bytes there
+    return peak
+
+def getCpuTime():
+    """ CPU time of the process in seconds """
+    if sys.platform == 'win32':
+        return sum(os.times()[:2])  # clock is wall time there
+    return clock()
+
+class PhaseProfile(object):
+    """
+    Wall and CPU time and peak memory growth of each phase of the pipeline,
+    for --profile. install wraps the functions that make up each phase, so the
+    default run does not pay for it. Times are exclusive: a phase run inside
+    another counts only under its own name. Memory is the growth in peak
+    resident memory seen as each call returns.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.phases = dict((name, [0.0, 0.0, 0]) for name in kPhases)  # wall, cpu, kB
+        self.stack = []     # [wall, cpu] of the phases nested in each running phase
+        self.wall = default_timer()
+        self.cpu = getCpuTime()
+        self.startPeak = self.peak = getPeakMemory()
+
+    def wrap(self, name, function):
+        """ function timed as part of phase name """
+        def timed(*args, **kwargs):
+            stack = self.stack
+            stack.append([0.0, 0.0])
+            wall = default_timer()
+            cpu = getCpuTime()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                wall = default_timer() - wall
+                cpu = getCpuTime() - cpu
+                nestedWall, nestedCpu = stack.pop()
+                stats = self.phases[name]
+                stats[0] += wall - nestedWall
+                stats[1] += cpu - nestedCpu
+                if stack:
+                    stack[-1][0] += wall
+                    stack[-1][1] += cpu
+                peak = getPeakMemory()
+                if peak > self.peak:
+                    stats[2] += peak - self.peak
+                    self.peak = peak
+        return timed
+
+    def install(self):
+        wrap = self.wrap
+        amf3reader.amf3reader.feed = wrap('decode', amf3reader.amf3reader.feed)
+        amf3reader.amf3reader.readMetric = wrap('decode', amf3reader.amf3reader.readMetric)
+        swfInstance.addMetric = wrap('addMetric', swfInstance.addMetric)
+        swfInstance.flushTimeLine = wrap('addMetric', swfInstance.flushTimeLine)
+        IndexList.addFrame = wrap('index', IndexList.addFrame)
+        StreamIndexList.addFrame = wrap('index', StreamIndexList.addFrame)
+        SpanIndex.__init__ = wrap('report', SpanIndex.__init__)
+        Reporter.addRange = wrap('report', Reporter.addRange)
+        Reporter.addEntries = wrap('report', Reporter.addEntries)
+        swfInstance.process = wrap('output', swfInstance.process)
+
+    def wrapFile(self, file):
+        """ file with its reads timed as the read phase """
+        return ProfiledFile(file, self.wrap('read', file.read))
+
+    def getResults(self, metricCount):
+        """ the figures since reset as a dict, ready for json """
+        wall = default_timer() - self.wall
+        cpu = getCpuTime() - self.cpu
+        phases = []
+        for name in kPhases + ['other']:
+            if name == 'other':  # whatever isn't in a phase
+                phaseWall = wall - sum(stats[0] for stats in self.phases.values())
+                phaseCpu = cpu - sum(stats[1] for stats in self.phases.values())
+                memory = getPeakMemory() - self.startPeak - sum(stats[2] for stats in self.phases.values())
+            else:
+                phaseWall, phaseCpu, memory = self.phases[name]
+            phases.append({'phase':name, 'wall':phaseWall, 'cpu':phaseCpu, 'memory':memory,
+                           'rate':metricCount/phaseWall if phaseWall > 0 else 0})
+        peak = getPeakMemory()
+        return {'metrics':metricCount, 'wall':wall, 'cpu':cpu, 'memory':peak - self.startPeak,
+                'peakMemory':peak, 'rate':metricCount/wall if wall > 0 else 0, 'phases':phases}
+
+def printProfile(results):
+    """ prints PhaseProfile.getResults as a table """
+    print "Profile of %d metrics:" % results['metrics']
+    print "  %-10s %10s %10s %10s %12s" % ("Phase", "Wall s", "CPU s", "Peak +kB", "Metrics/s")
+    for phase in results['phases'] + [dict(results, phase='total')]:
+        print "  %-10s %10.3f %10.3f %10d %12d" % (phase['phase'], phase['wall'], phase['cpu'],
+                                                 phase['memory'], phase['rate'])
+    print "Peak Memory = %d kB" % results['peakMemory']
+
+class ProfiledFile(object):
+    """ a file whose read is replaced, for PhaseProfile """
+    def __init__(self, file, read):
+        self.file = file
+        self.read = read
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+phaseProfile = None    # the PhaseProfile of --profile
+
+def getFileKey(filename):
+    """ size, mtime and content hash of a capture, the key of its cached session """
+    stat = os.stat(filename)
+    digest = hashlib.sha1()
+    f = open(filename, 'rb')
+    while True:
+        block = f.read(1 << 20)
+        if not block:
+            break
+        digest.update(block)
+    f.close()
+    return stat.st_size, stat.st_mtime, digest.hexdigest()
+
+def getCachePath(filename, key):
+    """ FILE.tlc next to the capture, or a file named by its key in --cache-dir """
+    if options.cacheDir:
+        return os.path.join(options.cacheDir, "%s-%d%s" % (key[2], key[0], kCacheSuffix))
+    return filename + kCacheSuffix
+
+def packColumn(values):
+    """ (typecode, bytes) for an all int or all float column, ('', values) for anything else """
+    kinds = set(map(type, values))
+    for typecode, kind in (('l', int), ('d', float)):
+        if kinds <= set([kind]):
+            try:
+                return typecode, array(typecode, values).tostring()
+            except OverflowError:
+                break
+    return '', values
+
+def unpackColumn(column):
+    typecode, data = column
+    if not typecode:
+        return data
+    values = array(typecode)
+    values.fromstring(data)
+    return values.tolist()
+
+def packIndexList(indexList):
+    return (packColumn(list(indexList)), array('I', indexList.positions).tostring(),
+            indexList.startTime, indexList.endTime)
+
+def unpackIndexList(indexList, state):
+    times, positions, indexList.startTime, indexList.endTime = state
+    indexList.extend(unpackColumn(times))
+    indexList.positions = array('I', positions).tolist()
+
+def saveSession(swf, path, key):
+    """
+    saves the flattened timeline of swf as columns: name id, depth, time, kind,
+    then the spans and values of the entries that have them
+    """
+    swf.flushTimeLine()
+    timeLine = swf.timeLine
+    times = timeLine.times.tolist()
+    if timeLine.intTimes:
+        times = map(int, times)
+    spans = [span for span, kind in izip(timeLine.spans, timeLine.kinds) if kind == kSpanEntry]
+    if timeLine.intSpans:
+        spans = map(int, spans)
+    ids = array('I', timeLine.ids)
+    depths = array('I', timeLine.depths)
+    kinds = timeLine.kinds
+    values = timeLine.values
+    date = None
+    if isinstance(swf.date, datetime):
+        date = tuple(swf.date.timetuple()[:6]) + (swf.date.microsecond,)
+    state = {
+        'version':kCacheVersion, 'platform':(sys.byteorder, array('l').itemsize),
+        'key':key, 'marker':options.frameMarker, 'names':symbols.names[:],
+        'info':dict((attr, getattr(swf, attr)) for attr in kSessionInfo), 'date':date,
+        'ids':ids.tostring(), 'depths':depths.tostring(), 'kinds':kinds.tostring(),
+        'times':packColumn(times), 'spans':packColumn(spans), 'values':packColumn(values),
+        'indexList':packIndexList(swf.indexList), 'renderList':packIndexList(swf.renderList) }
+    try:
+        data = marshal.dumps(state)
+    except ValueError:
+        return      # a value marshal can't save, e.g. an AMF date
+    folder = os.path.dirname(path)
+    try:
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        f = open(path + ".tmp", 'wb')
+        f.write(data)
+        f.close()
+        os.rename(path + ".tmp", path)
+    except (IOError, OSError):
+        pass    # read-only location, nothing is cached
+
+def loadSession(swf, path, key):
+    """ fills swf from a session saved by saveSession, False if there is none for key """
+    try:
+        f = open(path, 'rb')
+        try:
+            state = marshal.loads(f.read())
+        finally:
+            f.close()
+    except (IOError, EOFError, ValueError, TypeError):
+        return False
+    if (type(state) != dict or state.get('version') != kCacheVersion or
+        state['platform'] != (sys.byteorder, array('l').itemsize) or
+        state['key'] != key or state['marker'] != options.frameMarker):
+        return False
+    names = state['names']
+    remap = [symbols.intern(name) for name in names]
+    for attr, value in state['info'].items():
+        setattr(swf, attr, value)
+    if state['date']:
+        swf.date = datetime(*state['date'])
+    unpackIndexList(swf.indexList, state['indexList'])
+    unpackIndexList(swf.renderList, state['renderList'])
+    ids = array('I')
+    ids.fromstring(state['ids'])
+    depths = array('I')
+    depths.fromstring(state['depths'])
+    kinds = array('B')
+    kinds.fromstring(state['kinds'])
+    spans = iter(unpackColumn(state['spans']))
+    timeLine = swf.timeLine
+    timeLine.ids = array('i', [remap[nameId] for nameId in ids])
+    timeLine.depths = array('i', depths)
+    timeLine.kinds = kinds
+    timeLine.times = array('d', unpackColumn(state['times']))
+    timeLine.intTimes = state['times'][0] == 'l'
+    timeLine.spans = array('d', [next(spans) if kind == kSpanEntry else 0 for kind in kinds])
+    timeLine.intSpans = state['spans'][0] == 'l'
+    timeLine.valuePositions = array('I', [pos for pos, kind in enumerate(kinds) if kind == kValueEntry])
+    timeLine.values = unpackColumn(state['values'])
+    return True
+
+def evictCache(folder, limit):
+    """ deletes the least recently used sessions in folder until they total under limit bytes """
+    entries = []
+    for name in os.listdir(folder):
+        if name.endswith(kCacheSuffix):
+            path = os.path.join(folder, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    total = sum(entry[1] for entry in entries)
+    for mtime, size, path in entries:
+        if total <= limit:
+            break
+        os.remove(path)
+        total -= size
+
+def initJobs(jobOptions):
+    """ sets up a --jobs worker process """
+    global options
+    options = jobOptions
+
+def runJob(filename):
+    """ reports on filename in a --jobs worker, returns (filename, report text, summary) """
+    from StringIO import StringIO
+    out = sys.stdout
+    sys.stdout = StringIO()
+    summary = None
+    try:
+        try:
+            summary = reportCapture(filename).getSummary()
+        except Exception as e:
+            print "Failed: %s" % e
+        text = sys.stdout.getvalue()
+    finally:
+        sys.stdout = out
+    return filename, text, summary
+
+def reportJobs(filenames, jobs):
+    """ reports on filenames with a pool of jobs processes, in order, then the fleet summary """
+    from multiprocessing import Pool
+    summaries = []
+    missing = []
+    pool = Pool(jobs, initJobs, (options,))
+    try:
+        for filename, text, summary in pool.imap(runJob, filenames):
+            sys.stdout.write(text)
+            if summary is None:
+                missing.append(filename)
+            else:
+                summary['file'] = filename
+                summaries.append(summary)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    reportFleet(summaries, missing)
+
+def getSwfKey(name):
+    """ the name sessions of one SWF share, without its query string """
+    return name.split('?', 1)[0]
+
+def reportFleet(summaries, missing=[]):
+    """ prints the totals, spread and worst of the session summaries given """
+    print "\nFleet Summary"
+    print "Sessions = %d" % len(summaries)
+    if missing:
+        print "Sessions without a summary = %d: %s" % (len(missing), ", ".join(missing))
+    if not summaries:
+        return
+    runTime = sum(summary['runTime'] for summary in summaries)
+    span = sum(summary['span'] for summary in summaries)
+    print "Frame Count = %d" % sum(summary['frames'] for summary in summaries)
+    print "Run Time = ", timeStr(runTime)
+    print "Time in Player = ", timeStr(span)
+    if runTime:
+        print "Load = %.2f%%" % ((span/runTime)*100)
+
+    categories = SortDict()
+    for summary in summaries:
+        for category, categorySpan in summary['categories'].items():
+            categories.addTo(category, categorySpan)
+    print "Most time by Category (share of each session min, median, max):"
+    for category, categorySpan in categories.getSorted():
+        shares = sorted(100*summary['categories'].get(category, 0)/summary['span']
+                        for summary in summaries if summary['span'])
+        percent = int(round(100*categorySpan/span)) if span else 0
+        spread = "n/a"  # no session spent any time in the player
+        if shares:
+            spread = "%d%%, %d%%, %d%%" % (shares[0], getPercentile(shares, 50), shares[-1])
+        print "%s: %.3f %d%% (%s)" % (category, categorySpan/1000, percent, spread)
+
+    print "Highest Load:"
+    for summary in sorted(summaries, key=itemgetter('load'), reverse=True)[:kFleetWorst]:
+        print "  %.2f%% %s (%s)" % (summary['load'], summary['file'], getSwfKey(summary['name']))
+    print "Slowest Frames (p99):"
+    for summary in sorted(summaries, key=lambda summary: summary['frameTimes']['p99'],
+                          reverse=True)[:kFleetWorst]:
+        print "  %.2f ms %s (%s)" % (summary['frameTimes']['p99']/1000.0, summary['file'],
+                                    getSwfKey(summary['name']))
+
+    swfs = {}
+    for summary in summaries:
+        swfs.setdefault(getSwfKey(summary['name']), []).append(summary)
+    print "By SWF:"
+    for name, sessions in sorted(swfs.items(), key=lambda item: (-len(item[1]), item[0])):
+        runTime = sum(summary['runTime'] for summary in sessions)
+        load = 0
+        if runTime:
+            load = sum(summary['span'] for summary in sessions)/runTime*100
+        print "%s: sessions = %d, frames = %d, load = %.2f%%, FPS = %.2f, worst p99 = %.2f ms" % (
+            name, len(sessions), sum(summary['frames'] for summary in sessions), load,
+            sum(summary['fps'] for summary in sessions)/len(sessions),
+            max(summary['frameTimes']['p99'] for summary in sessions)/1000.0)
+
+def reportCapture(filename):
+    """ decodes filename as the options ask and prints its report, returns its swfInstance """
+    print("\nReport for: "+filename )
+    
+    swf = swfInstance()
+    swf.streaming = True
+    
+    if options.follow:
+        followCapture(filename, swf)
+        swf.process()
+        return swf
+
+    useCache = (options.cache or options.cacheDir) and not options.only and not options.hexDump
+    if useCache:
+        key = getFileKey(filename)
+        cachePath = getCachePath(filename, key)
+        if loadSession(swf, cachePath, key):
+            if options.cacheDir:
+                os.utime(cachePath, None)  # most recently used
+            swf.process()
+            return swf
+
+    if options.index and options.range and parseRange(options.range):
+        rstart, rend = parseRange(options.range)
+        loadIndexedRange(filename, swf, rstart, rend)
+        swf.process()
+        return swf
+    
+    file = open(filename, 'rb')
+    if phaseProfile is not None:
+        file = phaseProfile.wrapFile(file)
+    if options.hexDump:
+        tlm = amf3reader.amf3tracer()
+        metrics = amf3reader.iter_metrics(file, reader=tlm)
+    elif options.processes > 1 and not options.only:
+        tlm = None
+        metrics = amf3reader.iter_metrics_parallel(filename, options.processes)
+    elif options.mmap:
+        tlm = amf3reader.amf3mappedreader(file)
+        tlm.nameIds = True
+        tlm.nameFilter = getNameFilter()
+        metrics = tlm.readMetrics()
+    else:
+        tlm = amf3reader.amf3reader()
+        tlm.nameIds = True
+        tlm.nameFilter = getNameFilter()
+        metrics = amf3reader.iter_metrics(file, reader=tlm)
+    for metric in metrics:
+        if type(metric) == list: # we read all metrics as one list
+            swf.streaming = False
+            for m in metric:
+                swf.addMetric(m)
+        else:        
+            swf.addMetric(metric)
+    if isinstance(tlm, amf3reader.amf3mappedreader):
+        tlm.close()
+    file.close()
+    if useCache:
+        saveSession(swf, cachePath, key)
+        if options.cacheDir:
+            evictCache(options.cacheDir, options.cacheSize << 20)
+    swf.process()
+    return swf
 
 if __name__ == '__main__':
     import sys
@@ -634,35 +1834,94 @@ if __name__ == '__main__':
     parser.add_option("", "--range",
         action="store", dest="range", default="",
         help="set range of frames RANGE = start:end")
+    parser.add_option("", "--only",
+        action="store", dest="only", default=None, metavar="NAMES",
+        help="only decode metrics matching NAMES, comma separated patterns e.g. '.rend.*,.mem.*'")
+    parser.add_option("", "--index",
+        action="store_true", dest="index", default=False,
+        help="with --range, decode only the range using a FILE.idx sidecar index (built if needed)")
+    parser.add_option("-p", "--processes",
+        action="store",type="int", dest="processes", default=0,
+        help="decode each capture with # processes (not used with --only)")
+    parser.add_option("", "--mmap",
+        action="store_true", dest="mmap", default=False,
+        help="read the file through mmap instead of a private buffer")
+    parser.add_option("", "--cache",
+        action="store_true", dest="cache", default=False,
+        help="save the decoded session as FILE.tlc and reuse it while FILE is unchanged")
+    parser.add_option("", "--cache-dir",
+        action="store", dest="cacheDir", default=None, metavar="DIR",
+        help="like --cache, but keep the sessions in DIR")
+    parser.add_option("", "--cache-size",
+        action="store",type="int", dest="cacheSize", default=512, metavar="MB",
+        help="drop the least recently used sessions once --cache-dir holds more than MB (default 512)")
+    parser.add_option("", "--stream",
+        action="store_true", dest="stream", default=False,
+        help="build the summary while decoding, without keeping the metrics (not with -f, -a, -l, --range or --cache)")
+
+    parser.add_option("", "--follow",
+        action="store_true", dest="follow", default=False,
+        help="tail a capture as it is written, reporting on it every --interval seconds until ^C")
+    parser.add_option("", "--interval",
+        action="store",type="float", dest="interval", default=5, metavar="SECS",
+        help="with --follow, seconds between reports (default 5)")
+    parser.add_option("", "--window",
+        action="store",type="float", dest="window", default=10, metavar="SECS",
+        help="with --follow, seconds of the session each report covers (default 10)")
+
+    parser.add_option("-j", "--jobs",
+        action="store",type="int", dest="jobs", default=None,
+        help="report on the captures with # processes, then sum them up (not with -p or --follow)")
+
+    parser.add_option("", "--worst",
+        action="store",type="int", dest="worst", default=None, metavar="N",
+        help="report only the N longest frames, each with the frames either side (filtered by -l)")
+
+    parser.add_option("", "--profile",
+        action="store_true", dest="profile", default=False,
+        help="time each phase of the reports: wall and CPU time, peak memory and metrics/s")
+    parser.add_option("", "--profile-json",
+        action="store", dest="profileJson", default=None, metavar="FILE",
+        help="--profile, also saving the figures of each capture to FILE as JSON")
 
     (options, args) = parser.parse_args()
+    if options.worst is not None and options.worst < 1:
+        parser.error("--worst takes the number of frames to report, at least 1")
+    if options.jobs is not None and options.jobs < 1:
+        parser.error("--jobs takes the number of processes, at least 1")
+    if options.profileJson:
+        options.profile = True
+    if options.profile and (options.jobs or options.follow):
+        parser.error("--profile times captures reported in this process, not with --jobs or --follow")
+    if options.jobs and (options.processes > 1 or options.follow):
+        parser.error("--jobs decodes each capture in one process, it can't be used with -p or --follow")
+    if options.follow:
+        if len(args) != 1:
+            parser.error("--follow takes one capture")
+        options.stream = True   # a live session has no end, keep only the summary
+    if options.stream and (options.showFrames or options.showMetrics or options.loadFilter or
+                           options.range or options.cache or options.cacheDir or options.worst):
+        parser.error("--stream and --follow only give the summary, -f, -a, -l, --range, --cache and --worst need the metrics kept")
     options.frameMarker =  ".swf.frame"  # change this to redefine a frame
     
-    for filename in args:
-        print("\nReport for: "+filename )
-        
-        file = open(filename, 'rb')
-        data = file.read()
-        file.close()
-      
-        tlm = amf3reader.amf3reader()
-        tlm.verbose = options.hexDump
-        
-        tlm.setData(data)
-        
-        swf = swfInstance()
-        metric = tlm.readMetric() 
-        
-        #print type(metric) 
-        #print metric      
-        if type(metric) == list: # we read all metrics as one list
-            swf.streaming = False
-            for m in metric:
-                swf.addMetric(m)
-        else:        
-            swf.streaming = True
-            while metric:
-                swf.addMetric(metric)
-                metric = tlm.readMetric()
-        swf.process()
-        
+    if options.profile:
+        phaseProfile = PhaseProfile()
+        phaseProfile.install()
+    profiles = []
+
+    if options.jobs:
+        reportJobs(args, options.jobs)
+    else:
+        for filename in args:
+            if phaseProfile is not None:
+                phaseProfile.reset()
+            swf = reportCapture(filename)
+            if phaseProfile is not None:
+                results = phaseProfile.getResults(swf.metricCount)
+                printProfile(results)
+                profiles.append(dict(results, file=filename))
+    if options.profileJson:
+        import json
+        f = open(options.profileJson, 'w')
+        json.dump(profiles, f, indent=1)
+        f.close()